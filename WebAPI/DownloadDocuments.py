@@ -7,13 +7,13 @@
 
 
 
-import requests
-from requests.models import CaseInsensitiveDict
 from os.path import expanduser
 from datetime import datetime
 import json
 import re
 import os
+import itertools
+import utils.AquariusImaging as AquariusImaging
 
 
 #************************ CONFIGURATION ***********************************************************
@@ -39,22 +39,17 @@ if username=="":
     username=input("username: ")
 if password=="":
     password=input("password: ")
-creds = {'username': username,'password': password, 'grant_type':'password'}
-response = requests.post(server + '/token',creds)
+aqApi = AquariusImaging.AquariusWebAPIWrapper(server)
+aqApi.authenticate(username,password)
 
 
-if response.status_code==200:
+if aqApi.Authenticated:
 
     #create data file.
     indexDataFile = open(outputPath + "indexdata" + docType + ".txt",'w')
 
-    #get the authentication token
-    token = response.json()['access_token']
-    headers =  CaseInsensitiveDict()
-    headers['Authorization'] = "Bearer " + token
-
-    #get the query definition
-    response = requests.get(server + "/api/QueryDefs/" + docType,headers=headers)
+    #get the query definition (cached, see AquariusWebAPIWrapper.GetQueryDefinition)
+    response = aqApi.GetQueryDefinition(docType)
     queryDef=response.json()
 
     #set a search value
@@ -62,35 +57,28 @@ if response.status_code==200:
     numPolizaField[0]['searchValue']=filterValue
     jsondata = json.dumps(queryDef)
 
-    #run the query
-    payload={'json': jsondata}
-    response = requests.get(server + "/api/Documents",params=payload,headers=headers)
-    queryResult = response.json()
-    
     #begin document loop
     startPos = int(input("Starting Position (starts at 0):"))
-    endPos = startPos + int(input("Number of Documents to download (max: " + str((len(queryResult) - startPos)) + "):")) 
-    for document in range(startPos,endPos):
+    endPos = startPos + int(input("Number of Documents to download:")) 
+
+    #run the query. The results are streamed, so downloading starts with the first hit.
+    queryResult = aqApi.IterQuery(jsondata)
+    for document, queryDocument in enumerate(itertools.islice(queryResult, startPos, endPos), start=startPos):
     
-        print(str(document) + ": " + queryResult[document]['docID'])
+        print(str(document) + ": " + queryDocument['docID'])
     
-        dataLine = queryResult[document]['docID'] + '|'
+        dataLine = queryDocument['docID'] + '|'
     #   retrieve the document indexes
-        for index in range(6,len(queryResult[document]['indexData'])-1) :
-            dataLine = dataLine + queryResult[document]['indexData'][index]['value'] + '|'
+        for index in range(6,len(queryDocument['indexData'])-1) :
+            dataLine = dataLine + queryDocument['indexData'][index]['value'] + '|'
             
         
     #   begin page loop
-        for pageCounter in range(0,queryResult[document]['pageCount']):
-
-    #       retrieve the page
-            response = requests.get(server + "/api/DocPages/" + queryResult[document]['docID'] + "/" + str(pageCounter+1),headers=headers)
-            fileName = response.headers['Content-Disposition']
-            fileName = outputPath + re.sub('.*filename=(.+)(?: |$)','\\1',fileName)
-            imageFile = open(fileName, "wb+")
+        for pageCounter in range(0,queryDocument['pageCount']):
 
-    #       write the image to disk
-            imageFile.write(response.content)
+    #       retrieve the page and stream the image to disk
+            response, fileName = aqApi.SavePage(queryDocument['docID'], pageCounter+1, 'image',
+                                                lambda response: outputPath + re.sub('.*filename=(.+)(?: |$)','\\1',response.headers['Content-Disposition']))
             indexDataFile.write(dataLine + fileName + "\n")
             
 
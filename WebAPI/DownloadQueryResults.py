@@ -21,6 +21,8 @@ server = os.environ.get("AQUARIUSAPIURL")
 inputFile = "./GridViewExport.csv"
 multipage = False
 type = 'image'
+page_workers = 8    # number of pages downloaded at the same time
+document_workers = 1    # number of documents downloaded at the same time. More than 1 resumes from a journal file.
 #************************ CONFIGURATION ***********************************************************
 
 
@@ -33,9 +35,9 @@ uniqueID = datetime.now().strftime('%Y%m%d%H%M%S')
 
 try:
     #download the images
-    aqdownloader = AquariusDownloader.QueryResultsDownloader(server,username,password)
+    aqdownloader = AquariusDownloader.QueryResultsDownloader(server,username,password,pool_maxsize=page_workers+document_workers)
 
-    aqdownloader.download_documents(inputFile,multipage,uniqueID,type)
+    aqdownloader.download_documents(inputFile,multipage,uniqueID,type,page_workers,document_workers)
 
 except Exception as e:
     print (f"An exception occurred: {str(e)}")
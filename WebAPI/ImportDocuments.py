@@ -6,7 +6,6 @@
 ########################################################################################################################
 
 import time
-import cv2
 import os
 from urllib.parse import unquote
 from datetime import datetime
@@ -45,15 +44,15 @@ if os.path.exists(folderToWatch) == False:
 
 # Extract data from the QR code in the first image in the multipage tiff file
 def extract_qr_code_data(file_path):
-    from pyzbar.pyzbar import decode
+    from utils.BarcodeScanner import BarcodeScanner
     try:
  
-        img =  cv2.imread(file_path)
-        decoded_objects = decode(img)
-        if decoded_objects:            
+        # a downscaled pass first, the full resolution page only if that finds nothing
+        barcodes = BarcodeScanner().scan_file(file_path)
+        if barcodes:            
  
             # Return the first QR code value as a string
-            qr_code_value = decoded_objects[0].data.decode('utf-8')
+            qr_code_value = barcodes[0].data
             if qr_code_value:
  
                 print(f'{datetime.now()} QR Code Value: {qr_code_value}')
@@ -185,4 +184,5 @@ try:
 except KeyboardInterrupt:
     observer.stop()
 observer.join()
+handler.stop()
 
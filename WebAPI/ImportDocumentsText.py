@@ -93,8 +93,8 @@ def ProcessFile( file_path):
                             pdfSplitter = PDFSplitter.PDFSplitter(pdffile, dpi=300, threshold=210)
 
                             # loop through the pages and add each one to the document.
-                            for temp_path in pdfSplitter.get_temp_files():
-                                response = aqApi.AddPageToDocument(docID, temp_path)
+                            for page in pdfSplitter.get_pages():
+                                response = aqApi.AddPageToDocument(docID, page)
                                 if (response.status_code==200):
                                     print(f'{datetime.now()} Added page to document: {docID}')
 
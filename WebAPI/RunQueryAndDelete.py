@@ -52,10 +52,8 @@ if (response.status_code==200):
 queryField = list(filter(lambda x: (x['fieldName'] == queryField), queryDef['queryFields']))[0]
 queryField['searchValue'] = queryValue
 
-# STEP 3: run the query
-response = aqApi.RunQuery(json.dumps(queryDef))
-if (response.status_code==200):
-    queryResults = response.json()
+# STEP 3: run the query. The results are streamed, so deleting starts with the first hit.
+queryResults = aqApi.IterQuery(json.dumps(queryDef))
 # >>> from datetime import datetime, timedelta
 # >>> past = datetime.now() - timedelta(days=1)
 # >>> present = datetime.now()
@@ -1,8 +1,5 @@
-import time
 from service.service_base import SMWinservice
-from service.generic_watcher import GenericWatcher
-from service.process_import_docid import ImportProcessorBarcodeDocID
-from service.config_import import config_import 
+from service.supervisor import Supervisor
 
 class AquariusFileWatcherService(SMWinservice):
     _svc_name_ = "AquariusImportService"
@@ -12,28 +9,17 @@ class AquariusFileWatcherService(SMWinservice):
     def start(self):
         
         self.isrunning = True
-        
-        processors=[]
-
-        for folder, process_existing_files in config_import.folders_to_watch.items():
-        # Create a processor instance and inject the folder and flag into the handler.
-            processors.append(ImportProcessorBarcodeDocID({
-                "folder_to_watch": folder,
-                "process_existing_files": process_existing_files,
-                "server": config_import.aquarius_api_url,
-                "username": config_import.username,
-                "password": config_import.password
-            }))
 
-        self.watcher = GenericWatcher(processors)  
+        # the folders are watched by worker processes, see service.supervisor
+        self.supervisor = Supervisor('import')
+        self.supervisor.start()
 
     def main(self):
-        self.watcher.start()
-        self.watcher.run()
+        self.supervisor.run()
 
     def stop(self):
         self.isrunning = False
-        self.watcher.stop()  # Properly stop the watcher
+        self.supervisor.stop()  # the workers finish what they have queued
    
 
 if __name__ == '__main__':
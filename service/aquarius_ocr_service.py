@@ -1,9 +1,5 @@
-
-from service_base import SMWinservice
-from generic_watcher import GenericWatcher
-from service.process_ocr import OCRProcessor
-import service.config_ocr as config_ocr
-
+from service.service_base import SMWinservice
+from service.supervisor import Supervisor
 
 #******************* LOAD THE CONFIGURATION FILE ********************************************
 from dotenv import load_dotenv
@@ -18,25 +14,17 @@ class AquariusFileWatcherService(SMWinservice):
     def start(self):
         
         self.isrunning = True
-        
-        processors=[]
 
-        for folder, process_existing_files in config_ocr.folders_to_watch.items():
-        # Create a processor instance and inject the folder and flag into the handler.
-            processors.append(OCRProcessor({
-                "folder_to_watch": folder,
-                "process_existing_files": process_existing_files
-            }))
+        # the folders are watched by worker processes, see service.supervisor
+        self.supervisor = Supervisor('ocr')
+        self.supervisor.start()
 
-        self.watcher = GenericWatcher(processors)
-        
     def main(self):
-        self.watcher.start()
-        self.watcher.run()
+        self.supervisor.run()
 
     def stop(self):
         self.isrunning = False
-        self.watcher.stop()  # Properly stop the watcher
+        self.supervisor.stop()  # the workers finish what they have queued
    
 
 if __name__ == '__main__':
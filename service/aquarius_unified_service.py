@@ -1,10 +1,5 @@
-
 from service.service_base import SMWinservice
-from service.generic_watcher import GenericWatcher
-from service.process_ocr import OCRProcessor
-from service.process_fulltext import TextFileHandler
-import service.config_ocr as config_ocr
-import service.config_fulltext_index as config_fulltext_index
+from service.supervisor import Supervisor
 
 #******************* LOAD THE CONFIGURATION FILE ********************************************
 from dotenv import load_dotenv
@@ -19,40 +14,17 @@ class AquariusFileWatcherService(SMWinservice):
     def start(self):
         
         self.isrunning = True
-        
-        processors=[]
-
-        for folder, process_existing_files in config_ocr.folders_to_watch.items():
-        # Create a processor instance and inject the folder and flag into the handler.
-            processors.append(OCRProcessor({
-                "folder_to_watch": folder,
-                "process_existing_files": process_existing_files
-            }))
-
-        if config_fulltext_index.folder_solr_mapping:
-            for folder_to_watch, mapping in config_fulltext_index.folder_solr_mapping.items():
-
-                print(f"Watching folder: {folder_to_watch}")
-                                               
-                solrUrl = mapping["solrUrl"]
-                path_replacement_pairs = mapping["path_replacement_pairs"]
-                
-                processors.append(TextFileHandler({
-                    "folder_to_watch": folder_to_watch,
-                    "solrUrl": solrUrl,
-                    "path_replacement_pairs": path_replacement_pairs
-                }))
-                
-
-        self.watcher = GenericWatcher(processors)
-        
+
+        # the folders are watched by worker processes, see service.supervisor
+        self.supervisor = Supervisor('unified')
+        self.supervisor.start()
+
     def main(self):
-        self.watcher.start()
-        self.watcher.run()
+        self.supervisor.run()
 
     def stop(self):
         self.isrunning = False
-        self.watcher.stop()  # Properly stop the watcher
+        self.supervisor.stop()  # the workers finish what they have queued
    
 
 if __name__ == '__main__':
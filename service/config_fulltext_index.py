@@ -19,4 +19,20 @@ folder_solr_mapping = None
 # }
 
 process_existing_text_files = False
-process_existing_image_files = True
\ No newline at end of file
+process_existing_image_files = True
+
+# Text is sent to solr in batches: when batch_size documents or batch_bytes of text are waiting, or flush_interval
+# seconds after the first one arrived. Solr makes them searchable within commit_within milliseconds.
+solr_settings = {
+    "batch_size": 500,
+    "batch_bytes": 8 * 1024 * 1024,
+    "flush_interval": 5,
+    "commit_within": 10000
+}
+
+# Number of threads reading text files for solr, and number of files that can wait to be read.
+workers = 2
+queue_size = 1000
+
+# Count a copied file whose content is unchanged as already processed (see service.file_manifest).
+manifest_use_hash = False
@@ -15,4 +15,19 @@ aquarius_api_url = os.getenv("AQUARIUSAPIURL")
 
 username = os.getenv("USERNAME")
 
-password = os.getenv("PASSWORD")
\ No newline at end of file
+password = os.getenv("PASSWORD")
+
+# Pages split from a multipage TIFF are kept in memory on their way to the server, unless they are larger than this.
+page_spill_size = 8 * 1024 * 1024
+
+# Where to look for the docID barcode first, as (left, top, right, bottom) fractions of the page,
+# for example [(0.5, 0, 1, 0.5)] for the top right quarter. None searches the whole page, which is slower on
+# bitonal scans since the whole page is converted to grayscale for the first pass.
+barcode_zones = None
+
+# Number of files imported at the same time, and number of files that can wait to be imported.
+workers = 4
+queue_size = 1000
+
+# Count a copied file whose content is unchanged as already processed (see service.file_manifest).
+manifest_use_hash = False
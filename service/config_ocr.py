@@ -1,5 +1,28 @@
+import os
+
 folders_to_watch = {
     './service/WatchedFolder':True,'./service/WatchedFolder2':True
     # Add more folders to watch as needed separated by commas
 }
 
+# Number of OCR processes, None for one per CPU.
+ocr_workers = None
+
+# Number of files that can be waiting for OCR before the watcher waits for the workers to catch up, None for 4 per worker.
+ocr_queue_size = None
+
+# OCR backend: 'tesserocr' keeps tesseract loaded in each worker, 'pytesseract' runs the tesseract executable for
+# every page, 'auto' uses tesserocr when it is installed and pytesseract otherwise.
+ocr_backend = 'auto'
+
+# SQLite database of OCR results by image content and OCR settings, so files that were already OCR'd are skipped when
+# the folders are scanned again. None to always OCR.
+ocr_cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ocr_cache.db')
+
+# Number of threads queuing files for OCR (the OCR itself runs on ocr_workers processes), and number of files
+# that can wait to be queued.
+workers = 1
+queue_size = 1000
+
+# Count a copied file whose content is unchanged as already processed (see service.file_manifest).
+manifest_use_hash = False
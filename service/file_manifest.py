@@ -0,0 +1,81 @@
+########################################################################################################################
+#
+# Purpose: This class records which files each processor has handled, in a local SQLite database (in WAL mode, so
+# several services can share it). A file counts as handled while its size and modified time are the ones recorded,
+# so the startup scan only hands new or changed files to the processors. With use_hash, a file whose size or time
+# changed but whose content didn't (for example one that was copied again, which changes its time) also counts as
+# handled. That costs a hash of every file a processor handles, and of every handled file found with a new time.
+#
+########################################################################################################################
+
+from datetime import datetime
+import hashlib
+import os
+import sqlite3
+import threading
+
+
+def hash_file(file_path):
+    content_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+class FileManifest:
+
+    def __init__(self, path, use_hash=False):
+        self.path = path
+        self.use_hash = use_hash
+        self._lock = threading.Lock()
+
+        # shared by the watcher, the scan and the processors' threads, under a lock
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS processed_files (
+                                    processor TEXT NOT NULL,
+                                    path TEXT NOT NULL,
+                                    size INTEGER NOT NULL,
+                                    mtime_ns INTEGER NOT NULL,
+                                    hash TEXT,
+                                    processed_at TEXT NOT NULL,
+                                    PRIMARY KEY (processor, path))''')
+
+    def is_processed(self, processor, file_path):
+        """
+        Returns True if the processor has handled the file as it is now.
+        """
+        stat = os.stat(file_path)
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime_ns, hash FROM processed_files WHERE processor = ? AND path = ?', (processor, file_path)).fetchone()
+        if row is None:
+            return False
+
+        size, mtime_ns, content_hash = row
+        if size == stat.st_size and mtime_ns == stat.st_mtime_ns:
+            return True
+
+        if self.use_hash and content_hash and size == stat.st_size and hash_file(file_path) == content_hash:
+            # same content, just remember the new time
+            self.record(processor, file_path, content_hash)
+            return True
+
+        return False
+
+    def record(self, processor, file_path, content_hash=None):
+        """
+        Records that the processor has handled the file.
+        """
+        stat = os.stat(file_path)
+        if self.use_hash and content_hash is None:
+            content_hash = hash_file(file_path)
+
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO processed_files (processor, path, size, mtime_ns, hash, processed_at) VALUES (?, ?, ?, ?, ?, ?)',
+                             (processor, file_path, stat.st_size, stat.st_mtime_ns, content_hash, datetime.now().isoformat()))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -2,56 +2,171 @@
 # 
 # Purpose: This class represents a handler for file system events in the watched folder. 
 # It will call the processor to process the file when it is created. Processors encapsulate the actual
-# processing of the file.
+# processing of the file. Files are queued for the processor on a WorkQueue, with "workers" threads and room for
+# "queue_size" files (both from the processor config), so events are never held up by the processing. With a job
+# store, the queue is kept in it instead of in memory (see service.job_store), so queued work survives a restart and
+# failed files are retried.
+# Processors return False from Process when a file wasn't processed (or a Future, when it is processed in the
+# background). The other files are recorded in the manifest, if there is one, so the startup scan skips them.
+# A processor with an "extensions" attribute is only handed files with those extensions, so other files (like the
+# temporary files the OCR engine writes its text files to) are never queued.
 #
 ########################################################################################################################
 
 from watchdog.events import FileSystemEventHandler
-from PIL import Image
+from concurrent.futures import Future
 from datetime import datetime
 import os
-import time
+import threading
+from utils.FileStabilityTracker import FileStabilityTracker
+from service.work_queue import WorkQueue
+from service.job_store import JobQueue
 
 
 # This class handles the file system events for the folder being watched
 class FileHandler(FileSystemEventHandler):
 
-    def __init__(self, processor ):
+    def __init__(self, processor, manifest=None, job_store=None):
         super().__init__()
         
         self.running = True
         
         self.processor = processor
+        self.manifest = manifest
+
+        # identifies this processor's files in the manifest and the job store
+        self.manifest_key = f"{type(processor).__name__}:{os.path.abspath(processor.config['folder_to_watch'])}"
+
+        workers = processor.config.get('workers', 1)
+        queue_size = processor.config.get('queue_size', 1000)
+        if job_store is not None:
+            self.queue = JobQueue(job_store, self.manifest_key, self.ProcessFile, workers=workers, queue_size=queue_size, name=type(processor).__name__)
+        else:
+            self.queue = WorkQueue(self.ProcessFile, workers=workers, queue_size=queue_size, name=type(processor).__name__)
+
+        # new files are queued once they are completely written, see utils.FileStabilityTracker.
+        # "stable_time" in the processor config is how long a file's size must stay the same.
+        self.tracker = FileStabilityTracker(self.queue.put, stable_time=processor.config.get('stable_time', 2))
+
+        # files being processed right now, so the startup scan and the live events don't process a file twice at once
+        self._in_progress = set()
+        self._in_progress_lock = threading.Lock()
     
+    def wants(self, file_path):
+        """
+        Returns True if the file is one the processor handles.
+        """
+        extensions = getattr(self.processor, 'extensions', None)
+        return extensions is None or file_path.lower().endswith(tuple(extensions))
+
     def on_created(self, event):
+        # the file is processed once it is fully written
+        if not event.is_directory and self.wants(event.src_path):
+            self.tracker.track(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.tracker.modified(event.src_path)
+
+    def on_closed(self, event):
+        # only reported on platforms that can (inotify on Linux)
+        if not event.is_directory and self.wants(event.src_path):
+            self.tracker.closed(event.src_path)
+      
+    def on_moved(self, event):
+        # files that are written under a temporary name and then renamed (like the OCR text files)
+        # only show up as a move, and are complete by the time they are renamed.
         try:
-            if not event.is_directory:
-                file_path = event.src_path
-
-                # wait for the file to be fully written
-                file_size = -1
-                while os.path.getsize(file_path) != file_size:
-                    
-                    file_size = os.path.getsize(file_path)
-                    time.sleep(5) # wait for 5 seconds
-                
-                self.processor.Process(file_path)
+            if not event.is_directory and self.wants(event.dest_path):
+                self.queue.put(event.dest_path)
 
         except Exception as ex:
             print(f'{datetime.now()} Error: {str(ex)}')
-      
 
-    def ProcessALL(self):
+    def ProcessFile(self, file_path):
+        """
+        Hands a file to the processor and records it in the manifest. Returns what the processor returned, or False
+        if the file is already being processed (so a job store tries it again later).
+        """
+        with self._in_progress_lock:
+            if file_path in self._in_progress:
+                return False
+            self._in_progress.add(file_path)
+
+        try:
+            # queued again (by the scan and an event, say) after it was processed, and it hasn't changed since
+            if self._unchanged(file_path):
+                return True
+
+            result = self.processor.Process(file_path)
+            self._record(file_path, result)
+            return result
+        finally:
+            with self._in_progress_lock:
+                self._in_progress.discard(file_path)
+
+    def _unchanged(self, file_path):
         try:
-            # To process all files in the folder:
-            for root, _, files in os.walk(self.processor.config['folder_to_watch'],):
-                    for filename in files:
-                                                
-                        self.processor.Process(os.path.join(root,filename))
+            return self.manifest is not None and self.manifest.is_processed(self.manifest_key, file_path)
+        except OSError:
+            return False
 
+    def _record(self, file_path, result):
+        if self.manifest is None or result is False:
+            return
+
+        if isinstance(result, Future):
+            # processed in the background, record it once that has worked
+            def done(future):
+                if not future.cancelled() and future.exception() is None:
+                    self._record(file_path, True)
+            result.add_done_callback(done)
+            return
+
+        try:
+            self.manifest.record(self.manifest_key, file_path)
         except Exception as ex:
-            print(f'{datetime.now()} Error: {str(ex)}')
+            print(f'{datetime.now()} Error recording {file_path}: {str(ex)}')
+
+    def ProcessALL(self):
+        """
+        Processes the files in the folder tree that the manifest doesn't have as processed (or all of them,
+        without a manifest).
+        """
+        processed = 0
+        skipped = 0
+
+        # To process all files in the folder:
+        for root, _, files in os.walk(self.processor.config['folder_to_watch'],):
+                for filename in files:
+                    if not self.running:
+                        return
+
+                    file_path = os.path.join(root,filename)
+                    if not self.wants(file_path):
+                        continue
+
+                    try:
+                        if self.manifest is not None and self.manifest.is_processed(self.manifest_key, file_path):
+                            skipped += 1
+                            continue
+
+                        # waits here while the queue is full
+                        if self.queue.put(file_path):
+                            processed += 1
+
+                    except Exception as ex:
+                        print(f'{datetime.now()} Error: {str(ex)}')
+
+        print(f"{datetime.now()} Scanned {self.processor.config['folder_to_watch']}: {processed} files queued, {skipped} already done")
             
 
     def stop(self):
+        # stop the scan and the checks for new files, then finish the files already queued
         self.running = False
+        unsettled = self.tracker.stop()
+        self.queue.stop()
+
+        # files that were still being written are kept for the next start
+        if unsettled:
+            self.queue.defer(unsettled)
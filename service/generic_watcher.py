@@ -3,12 +3,21 @@
 # Purpose: This class represents an observer, which accepts a list of injected processors. Each processor creates a handler 
 # to watch for file system events in the specified folder. Each handler will call it's processor to process files as 
 # they are created in the watched folder. The observer will start the handlers and run them in separate threads.
+# Existing files are scanned in the background once the folders are being watched, and the files that have been
+# processed are recorded in a manifest (see service.file_manifest), so a restart only processes new or changed files.
 #
 ########################################################################################################################
 
 from watchdog.observers import Observer  
 from service.generic_handler import FileHandler
+from service.file_manifest import FileManifest
+from service.job_store import JobStore
+import threading
 import time
+import os
+
+DEFAULT_MANIFEST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'file_manifest.db')
+DEFAULT_JOB_STORE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs.db')
 
 
 #******************* LOAD THE CONFIGURATION FILE ********************************************
@@ -18,11 +27,22 @@ load_dotenv()
 
 class GenericWatcher:
   
-    def __init__(self, processors):
+    def __init__(self, processors, manifest_path=DEFAULT_MANIFEST_PATH, job_store_path=DEFAULT_JOB_STORE_PATH, manifest_use_hash=False, **job_store_settings):
+        """
+        manifest_path is the database of processed files, None to process every existing file on start. With
+        manifest_use_hash, a file whose content is unchanged counts as processed even if its time changed.
+        job_store_path is the database of queued files (see service.job_store, which also explains the
+        job_store_settings), None to queue them in memory only.
+        """
         self.running = True
+        self.stopped = False
+        self._stop_lock = threading.Lock()
         self.observer = Observer()
         self.file_handlers = []
+        self.scan_threads = []
         self.processors = processors
+        self.manifest = FileManifest(manifest_path, use_hash=manifest_use_hash) if manifest_path else None
+        self.job_store = JobStore(job_store_path, **job_store_settings) if job_store_path else None
 
     def start(self):
 
@@ -31,11 +51,7 @@ class GenericWatcher:
 
             print(f"Watching folder: {processor.config['folder_to_watch']}")
                     
-            image_handler =  FileHandler( processor)
-            
-            # Optionally, process all existing files in the folder tree:
-            if processor.config['process_existing_files']:
-                image_handler.ProcessALL()
+            image_handler =  FileHandler( processor, self.manifest, self.job_store)
 
             # schedule the handler to watch the folder
             self.file_handlers.append(image_handler)
@@ -43,16 +59,39 @@ class GenericWatcher:
                 
         self.observer.start()
 
+        # Optionally, process the existing files in the folder trees, while new files are already being handled:
+        for image_handler in self.file_handlers:
+            if image_handler.processor.config['process_existing_files']:
+                scan_thread = threading.Thread(target=image_handler.ProcessALL, name='scan', daemon=True)
+                scan_thread.start()
+                self.scan_threads.append(scan_thread)
+
             
         
     def stop(self):
 
         self.running = False
-        for image_handler in self.file_handlers:
-            image_handler.stop()
-           
-        self.observer.stop()
-        self.observer.join()
+
+        # stop can be called from another thread while run() is stopping, the second call waits for the first
+        with self._stop_lock:
+            if self.stopped:
+                return
+            self.stopped = True
+
+            # no new events, then let each handler finish the files it has queued
+            self.observer.stop()
+            self.observer.join()
+
+            for image_handler in self.file_handlers:
+                image_handler.stop()
+
+            for scan_thread in self.scan_threads:
+                scan_thread.join()
+
+            # let processors that work in the background finish what they have queued
+            for processor in self.processors:
+                if hasattr(processor, 'stop'):
+                    processor.stop()
 
     def run(self):
 
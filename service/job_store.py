@@ -0,0 +1,315 @@
+########################################################################################################################
+#
+# Purpose: A durable queue of files to process, kept in a local SQLite database (in WAL mode), so work survives a
+# service stopping or crashing. Each file is a job in one of these states:
+#
+#   queued  - waiting for a worker
+#   running - claimed by a worker. A file queued again while it runs is flagged, and queued again once it finishes
+#   done    - processed
+#   failed  - the last attempt failed, it is tried again after a backoff (backoff_base * 2^(attempts-1) seconds,
+#             at most backoff_max)
+#   dead    - failed max_attempts times, it stays here (with its last error) until the file shows up again
+#
+# Workers claim jobs in a write transaction, so any number of threads and processes can share the store without two
+# of them getting the same job. Jobs left running by a service that stopped are queued again when it starts
+# (recover), and jobs whose worker hasn't finished within lease_time seconds can be claimed by another worker.
+# Done jobs are deleted once they are done_retention seconds old (checked on start, then hourly while the workers
+# are idle), so the store doesn't grow with every file ever processed; the manifest remembers those files.
+#
+# JobQueue has the same interface as WorkQueue, with the store instead of memory behind it.
+#
+########################################################################################################################
+
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from collections import namedtuple
+import contextlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+Job = namedtuple('Job', ['id', 'queue', 'path', 'attempts'])
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+DEAD = 'dead'
+
+# how often done jobs past their retention are deleted, in seconds
+PURGE_INTERVAL = 3600
+
+
+class JobStore:
+
+    def __init__(self, path, max_attempts=5, backoff_base=30, backoff_max=3600, lease_time=3600, done_retention=7 * 24 * 3600):
+        """
+        done_retention is how long done jobs are kept, in seconds (None keeps them).
+        """
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease_time = lease_time
+        self.done_retention = done_retention
+        self._lock = threading.Lock()
+        self._purged_at = None
+
+        # transactions are started explicitly (isolation_level=None), so claims can take the write lock up front
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                                    id INTEGER PRIMARY KEY,
+                                    queue TEXT NOT NULL,
+                                    path TEXT NOT NULL,
+                                    state TEXT NOT NULL,
+                                    attempts INTEGER NOT NULL DEFAULT 0,
+                                    available_at REAL NOT NULL,
+                                    claimed_by TEXT,
+                                    claimed_at REAL,
+                                    last_error TEXT,
+                                    updated_at TEXT NOT NULL,
+                                    requeue INTEGER NOT NULL DEFAULT 0,
+                                    UNIQUE (queue, path))''')
+            # stores created before the requeue flag
+            if 'requeue' not in [column[1] for column in self._db.execute('PRAGMA table_info(jobs)')]:
+                self._db.execute('ALTER TABLE jobs ADD COLUMN requeue INTEGER NOT NULL DEFAULT 0')
+            self._db.execute('CREATE INDEX IF NOT EXISTS jobs_available ON jobs (queue, state, available_at)')
+
+    def _write(self, sql, parameters=()):
+        with self._lock:
+            return self._db.execute(sql, parameters).rowcount
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # a write transaction, with the write lock taken up front
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._db
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+
+    def enqueue(self, queue, path):
+        """
+        Queues a file. Returns False if it is already queued or waiting to be retried.
+        A file that was done (or dead) is queued again, since it has changed or come back, and a running one is
+        queued again once it finishes.
+        """
+        now = datetime.now().isoformat()
+        with self._transaction() as db:
+            count = db.execute(f'''INSERT INTO jobs (queue, path, state, attempts, available_at, updated_at) VALUES (?, ?, '{QUEUED}', 0, ?, ?)
+                                   ON CONFLICT (queue, path) DO UPDATE SET state = '{QUEUED}', attempts = 0, available_at = excluded.available_at,
+                                       claimed_by = NULL, claimed_at = NULL, last_error = NULL, updated_at = excluded.updated_at
+                                   WHERE state IN ('{DONE}', '{DEAD}')''',
+                               (queue, path, time.time(), now)).rowcount
+            if not count:
+                count = db.execute(f"UPDATE jobs SET requeue = 1, updated_at = ? WHERE queue = ? AND path = ? AND state = '{RUNNING}' AND requeue = 0",
+                                   (now, queue, path)).rowcount
+        return count > 0
+
+    def claim(self, queue, worker):
+        """
+        Claims the next job that is due, or returns None.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute(f'''SELECT id, path, attempts FROM jobs
+                                  WHERE queue = ? AND ((state IN ('{QUEUED}', '{FAILED}') AND available_at <= ?)
+                                                       OR (state = '{RUNNING}' AND claimed_at <= ?))
+                                  ORDER BY available_at LIMIT 1''', (queue, now, now - self.lease_time)).fetchone()
+            if row is not None:
+                db.execute(f"UPDATE jobs SET state = '{RUNNING}', attempts = attempts + 1, claimed_by = ?, claimed_at = ?, updated_at = ? WHERE id = ?",
+                           (worker, now, datetime.now().isoformat(), row[0]))
+
+        return Job(row[0], queue, row[1], row[2] + 1) if row else None
+
+    def complete(self, job):
+        # queued again straight away if the file was queued again while it was running
+        self._write(f'''UPDATE jobs SET state = CASE WHEN requeue THEN '{QUEUED}' ELSE '{DONE}' END, attempts = CASE WHEN requeue THEN 0 ELSE attempts END,
+                               available_at = ?, requeue = 0, claimed_by = NULL, last_error = NULL, updated_at = ? WHERE id = ?''',
+                    (time.time(), datetime.now().isoformat(), job.id))
+
+    def fail(self, job, error):
+        """
+        Records a failed attempt: the job is retried after a backoff, or is dead after max_attempts.
+        """
+        if job.attempts >= self.max_attempts:
+            state, available_at = DEAD, time.time()
+            print(f'{datetime.now()} Giving up on {job.path} after {job.attempts} attempts: {error}')
+        else:
+            state, available_at = FAILED, time.time() + min(self.backoff_max, self.backoff_base * 2 ** (job.attempts - 1))
+            print(f'{datetime.now()} Error processing {job.path} (attempt {job.attempts}), retrying later: {error}')
+
+        # a file queued again while it was running gets a fresh start instead
+        self._write(f'''UPDATE jobs SET state = CASE WHEN requeue THEN '{QUEUED}' ELSE ? END, attempts = CASE WHEN requeue THEN 0 ELSE attempts END,
+                               available_at = CASE WHEN requeue THEN ? ELSE ? END, requeue = 0, claimed_by = NULL, last_error = ?, updated_at = ? WHERE id = ?''',
+                    (state, time.time(), available_at, str(error), datetime.now().isoformat(), job.id))
+
+    def recover(self, queue):
+        """
+        Queues the jobs left running when the service last stopped. Call before starting the workers.
+        """
+        count = self._write(f"UPDATE jobs SET state = '{QUEUED}', requeue = 0, claimed_by = NULL, claimed_at = NULL, updated_at = ? WHERE queue = ? AND state = '{RUNNING}'",
+                            (datetime.now().isoformat(), queue))
+        if count:
+            print(f'{datetime.now()} Queued {count} interrupted jobs again for {queue}')
+        self.purge_expired()
+        return count
+
+    def purge(self, older_than):
+        """
+        Deletes the done jobs that finished more than older_than seconds ago. Returns how many were deleted.
+        """
+        cutoff = (datetime.now() - timedelta(seconds=older_than)).isoformat()
+        count = self._write(f"DELETE FROM jobs WHERE state = '{DONE}' AND updated_at < ?", (cutoff,))
+        if count:
+            print(f'{datetime.now()} Deleted {count} done jobs older than {timedelta(seconds=older_than)}')
+        return count
+
+    def purge_expired(self):
+        """
+        Deletes the done jobs past done_retention, at most once every PURGE_INTERVAL seconds.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self.done_retention is None or (self._purged_at is not None and now - self._purged_at < PURGE_INTERVAL):
+                return 0
+            self._purged_at = now
+        try:
+            return self.purge(self.done_retention)
+        except sqlite3.Error as ex:
+            print(f'{datetime.now()} Error deleting done jobs: {str(ex)}')
+            return 0
+
+    def count(self, queue, state=QUEUED):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM jobs WHERE queue = ? AND state = ?', (queue, state)).fetchone()[0]
+
+    def dead_jobs(self, queue):
+        """
+        Returns (path, attempts, last error) for the jobs that have given up.
+        """
+        with self._lock:
+            return self._db.execute(f"SELECT path, attempts, last_error FROM jobs WHERE queue = ? AND state = '{DEAD}' ORDER BY updated_at", (queue,)).fetchall()
+
+
+class JobQueue:
+
+    def __init__(self, store, queue, process, workers=1, queue_size=1000, name='worker', poll_interval=5):
+        """
+        process is called with each file path, on one of workers threads. It returns False (or raises) when the file
+        wasn't processed, or a Future when it is being processed in the background. put() waits while queue_size
+        jobs are queued. Workers look for jobs that became due (retries) every poll_interval seconds.
+        """
+        self.store = store
+        self.queue = queue
+        self.process = process
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+        self._condition = threading.Condition()
+        self._stopping = False
+
+        store.recover(queue)
+
+        self._threads = [threading.Thread(target=self._run, name=f'{name}-{i}', daemon=True) for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, file_path):
+        """
+        Queues a file, waiting while the queue is full. Returns False if the file was already queued
+        or the queue is stopping.
+        """
+        with self._condition:
+            while not self._stopping and self.store.count(self.queue) >= self.queue_size:
+                self._condition.wait(self.poll_interval)
+            if self._stopping:
+                return False
+
+        if not self.store.enqueue(self.queue, file_path):
+            return False
+
+        with self._condition:
+            self._condition.notify_all()
+        return True
+
+    def _run(self):
+        worker = f'{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}'
+        while True:
+            with self._condition:
+                if self._stopping:
+                    return
+
+            job = self.store.claim(self.queue, worker)
+            if job is None:
+                self.store.purge_expired()
+                with self._condition:
+                    if not self._stopping:
+                        self._condition.wait(self.poll_interval)
+                continue
+
+            try:
+                result = self.process(job.path)
+            except Exception as ex:
+                self._finish(job, ex)
+                continue
+            self._finish(job, result)
+
+    def _finish(self, job, result):
+        if isinstance(result, Future):
+            # processed in the background, finish the job when that is done
+            def done(future):
+                if future.cancelled():
+                    self._finish(job, Exception('cancelled'))
+                else:
+                    self._finish(job, future.exception() or True)
+            result.add_done_callback(done)
+            return
+
+        try:
+            if isinstance(result, BaseException):
+                self.store.fail(job, result)
+            elif result is False:
+                self.store.fail(job, 'not processed')
+            else:
+                self.store.complete(job)
+        except Exception as ex:
+            print(f'{datetime.now()} Error updating job for {job.path}: {str(ex)}')
+
+        with self._condition:
+            self._condition.notify_all()
+
+    def defer(self, file_paths):
+        """
+        Called after stop() with files that weren't ready to be processed, which are queued in the store for the
+        next start.
+        """
+        count = 0
+        for file_path in file_paths:
+            try:
+                count += self.store.enqueue(self.queue, file_path)
+            except Exception as ex:
+                print(f'{datetime.now()} Error queuing {file_path}: {str(ex)}')
+        if count:
+            print(f'{datetime.now()} Queued {count} files for the next start')
+
+    @property
+    def pending(self):
+        return self.store.count(self.queue)
+
+    def stop(self):
+        """
+        Stops taking new files and waits for the jobs being processed. Jobs still queued stay in the store
+        for the next start.
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
@@ -0,0 +1,109 @@
+##################################################################################################
+# OCR backends used by the OCR engine workers. A backend turns a PIL image into text.
+#
+#   pytesseract - runs the tesseract executable for every image. It has to load the language models
+#                 and read the image back from a temporary file each time, but only needs tesseract
+#                 on the path.
+#   tesserocr   - calls the Tesseract C API in the worker process. The models are loaded once per
+#                 worker and kept, and images are passed in memory. Needs the tesserocr package.
+#   auto        - tesserocr if it can be loaded, pytesseract otherwise.
+#
+# Backends are created once per worker process (see get_backend) and reused for every page.
+##################################################################################################
+
+import shlex
+from datetime import datetime
+
+BACKENDS = ('auto', 'tesserocr', 'pytesseract')
+
+
+def parse_tesseract_config(tesseract_config):
+    """
+    Splits a tesseract command line config ('-l eng --oem 3 --psm 1 -c name=value') into the language,
+    oem, psm and a dictionary of variables.
+    """
+    lang, oem, psm, variables = 'eng', None, None, {}
+    args = shlex.split(tesseract_config)
+    for i, arg in enumerate(args[:-1]):
+        if arg == '-l':
+            lang = args[i + 1]
+        elif arg == '--oem':
+            oem = int(args[i + 1])
+        elif arg == '--psm':
+            psm = int(args[i + 1])
+        elif arg == '-c':
+            name, _, value = args[i + 1].partition('=')
+            variables[name] = value
+    return lang, oem, psm, variables
+
+
+class PytesseractBackend():
+    name = 'pytesseract'
+
+    def __init__(self, tesseract_config):
+        import pytesseract
+        self.pytesseract = pytesseract
+        self.tesseract_config = tesseract_config
+
+    def image_to_string(self, img):
+        return self.pytesseract.image_to_string(img, config=self.tesseract_config).strip()
+
+    def close(self):
+        pass
+
+
+class TesserocrBackend():
+    name = 'tesserocr'
+
+    def __init__(self, tesseract_config):
+        import tesserocr
+        lang, oem, psm, variables = parse_tesseract_config(tesseract_config)
+
+        settings = {'lang': lang}
+        if oem is not None:
+            settings['oem'] = tesserocr.OEM(oem)
+        if psm is not None:
+            settings['psm'] = tesserocr.PSM(psm)
+
+        # loads the language models, which then stay loaded for the life of the worker
+        self.api = tesserocr.PyTessBaseAPI(**settings)
+        for name, value in variables.items():
+            self.api.SetVariable(name, value)
+
+    def image_to_string(self, img):
+        self.api.SetImage(img)
+        return self.api.GetUTF8Text().strip()
+
+    def close(self):
+        self.api.End()
+
+
+def create_backend(name, tesseract_config):
+    if name not in BACKENDS:
+        raise Exception(f'Unknown OCR backend {name}, expected one of {BACKENDS}')
+
+    if name == 'pytesseract':
+        return PytesseractBackend(tesseract_config)
+
+    try:
+        return TesserocrBackend(tesseract_config)
+    except (ImportError, RuntimeError) as ex:
+        if name == 'tesserocr':
+            raise
+        print(f'{datetime.now()} tesserocr not available ({ex}), using pytesseract')
+        return PytesseractBackend(tesseract_config)
+
+
+# the backends created in this process, by name and config
+_backends = {}
+
+
+def get_backend(name, tesseract_config):
+    """
+    Returns this process's backend for name and config, creating it on first use.
+    """
+    key = (name, tesseract_config)
+    backend = _backends.get(key)
+    if backend is None:
+        backend = _backends[key] = create_backend(name, tesseract_config)
+    return backend
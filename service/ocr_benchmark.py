@@ -0,0 +1,73 @@
+##################################################################################################
+# Compares the OCR backends (see service.ocr_backends) on a set of sample images, in one process,
+# so the numbers show the cost per page that each OCR worker pays.
+#
+# Usage: python -m service.ocr_benchmark [--repeat N] image_or_pdf ...
+##################################################################################################
+
+import sys
+import time
+from PIL import Image
+
+from service.ocr_backends import create_backend
+from service.ocr_engine import DEFAULT_TESSERACT_CONFIG, count_pages
+
+def load_pages(file_paths, dpi=300):
+    # decode every page up front, so only the OCR is timed
+    pages = []
+    for file_path in file_paths:
+        if file_path.lower().endswith('.pdf'):
+            import fitz  # PyMuPDF
+            with fitz.open(file_path) as pdf_document:
+                zoom = dpi / 72
+                for page in pdf_document:
+                    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY)
+                    pages.append(Image.frombytes("L", [pix.width, pix.height], pix.samples))
+        else:
+            for page_number in range(count_pages(file_path)):
+                with Image.open(file_path) as img:
+                    img.seek(page_number)
+                    img.load()
+                    pages.append(img.copy())
+    return pages
+
+def benchmark(backend_name, pages, repeat):
+    started = time.perf_counter()
+    backend = create_backend(backend_name, DEFAULT_TESSERACT_CONFIG)
+    startup = time.perf_counter() - started
+
+    texts = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        texts = [backend.image_to_string(page) for page in pages]
+    elapsed = time.perf_counter() - started
+    backend.close()
+
+    count = len(pages) * repeat
+    print(f"{backend_name:12} startup {startup:6.2f}s  {count} pages in {elapsed:7.2f}s  {elapsed / count * 1000:8.1f} ms/page")
+    return texts
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    repeat = 1
+    if len(args) > 1 and args[0] == '--repeat':
+        repeat = int(args[1])
+        args = args[2:]
+
+    if not args:
+        print("Usage: python -m service.ocr_benchmark [--repeat N] image_or_pdf ...")
+        sys.exit(1)
+
+    pages = load_pages(args)
+    print(f"{len(pages)} pages from {len(args)} files, {repeat} time(s) each")
+
+    results = {}
+    for backend_name in ('pytesseract', 'tesserocr'):
+        try:
+            results[backend_name] = benchmark(backend_name, pages, repeat)
+        except (ImportError, RuntimeError) as ex:
+            print(f"{backend_name:12} not available: {ex}")
+
+    if len(results) == 2:
+        same = sum(1 for a, b in zip(results['pytesseract'], results['tesserocr']) if a == b)
+        print(f"{same} of {len(pages)} pages gave identical text")
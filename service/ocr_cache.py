@@ -0,0 +1,74 @@
+##################################################################################################
+# This class remembers the OCR text of every image by a hash of its content and the OCR settings,
+# in a local SQLite database, so files that have already been OCR'd with the same settings are
+# skipped when the service restarts and rescans its folders, or when the same image shows up again.
+# The hash of each file is kept with its size and modified time, so an unchanged file isn't even
+# read again on a rescan.
+##################################################################################################
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+from service.ocr_backends import parse_tesseract_config
+
+
+def ocr_settings(tesseract_config, dpi, page_separator):
+    """
+    Returns the key for the settings that change the OCR text: languages, oem, psm, tesseract variables,
+    the resolution PDFs are rendered at and the page separator.
+    """
+    lang, oem, psm, variables = parse_tesseract_config(tesseract_config)
+    return json.dumps({'lang': lang, 'oem': oem, 'psm': psm, 'variables': variables, 'dpi': dpi, 'page_separator': page_separator}, sort_keys=True)
+
+
+class OCRCache():
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+        # the engine's callbacks run on other threads, so the connection is shared under a lock
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS ocr_results (hash TEXT NOT NULL, settings TEXT NOT NULL, text TEXT NOT NULL, PRIMARY KEY (hash, settings))')
+            self._db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, hash TEXT NOT NULL)')
+
+    def hash_file(self, file_path):
+        """
+        Returns the SHA-256 of a file's content, reading the file only if it changed since it was last hashed.
+        """
+        stat = os.stat(file_path)
+        with self._lock:
+            row = self._db.execute('SELECT hash FROM files WHERE path = ? AND size = ? AND mtime_ns = ?', (file_path, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row:
+            return row[0]
+
+        content_hash = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                content_hash.update(chunk)
+        content_hash = content_hash.hexdigest()
+
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO files (path, size, mtime_ns, hash) VALUES (?, ?, ?, ?)', (file_path, stat.st_size, stat.st_mtime_ns, content_hash))
+        return content_hash
+
+    def get(self, content_hash, settings):
+        """
+        Returns the cached text for an image hash and settings, or None.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT text FROM ocr_results WHERE hash = ? AND settings = ?', (content_hash, settings)).fetchone()
+        return row[0] if row else None
+
+    def set(self, content_hash, settings, text):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO ocr_results (hash, settings, text) VALUES (?, ?, ?)', (content_hash, settings, text))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,205 @@
+##################################################################################################
+# This class runs OCR jobs on a pool of worker processes, so a backlog of images is OCR'd on
+# every core instead of one at a time on the thread that found the files.
+# The number of jobs waiting or running is bounded: once the queue is full, submit() blocks until
+# a worker is done, so a folder of thousands of files doesn't pile up in memory.
+# Multi-page TIFFs and PDFs are OCR'd a page at a time, with the pages spread over the workers, and
+# the text of the pages is joined in page order, separated by page_separator.
+# The text file is written under a temporary name that is renamed when complete, so nothing ever
+# sees half a text file.
+# With a cache, files whose content has been OCR'd before with the same settings are skipped.
+##################################################################################################
+
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime
+from service.ocr_backends import get_backend
+from service.ocr_cache import OCRCache, ocr_settings
+from service.service_runners import use_python_for_processes
+
+DEFAULT_TESSERACT_CONFIG = '-c preserve_interword_spaces=1 --oem {} --psm {} -l {}'.format('3', '1', 'eng+spa')
+PAGE_SEPARATOR = '\n\f\n'  # a form feed between pages, like tesseract uses
+OCR_EXTENSIONS = ('.tif', '.tiff', '.jpg', '.pdf')
+
+
+def write_text_file(textkey, text):
+    """
+    Writes text to textkey through a temporary file in the same folder, which is renamed into place.
+    """
+    directory = os.path.dirname(os.path.abspath(textkey))
+    with tempfile.NamedTemporaryFile('w', dir=directory, prefix=os.path.basename(textkey) + '.', suffix='.tmp', delete=False) as f:
+        f.write(text)
+    try:
+        os.replace(f.name, textkey)
+    except OSError:
+        os.remove(f.name)
+        raise
+
+
+def count_pages(file_path):
+    if file_path.lower().endswith('.pdf'):
+        import fitz  # PyMuPDF
+        with fitz.open(file_path) as pdf_document:
+            return len(pdf_document)
+
+    from PIL import Image
+    with Image.open(file_path) as img:
+        return getattr(img, 'n_frames', 1)
+
+
+def ocr_page(file_path, page_number, backend_name, tesseract_config, dpi):
+    """
+    OCRs one page (0 based) of an image or PDF file and returns the text. Runs in a worker process.
+    """
+    from PIL import Image
+    backend = get_backend(backend_name, tesseract_config)
+
+    if file_path.lower().endswith('.pdf'):
+        import fitz  # PyMuPDF
+        with fitz.open(file_path) as pdf_document:
+            # render the page in grayscale at the given resolution (PDF default resolution is 72 dpi)
+            zoom = dpi / 72
+            pix = pdf_document.load_page(page_number).get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY)
+            img = Image.frombytes("L", [pix.width, pix.height], pix.samples)
+            return backend.image_to_string(img)
+
+    with Image.open(file_path) as img:
+        img.seek(page_number)
+        return backend.image_to_string(img)
+
+
+class _OCRJob():
+    # collects the text of a file's pages as the workers finish them, and writes the text file after the last one.
+
+    def __init__(self, file_path, page_count, page_separator, cache=None, cache_key=None):
+        self.file_path = file_path
+        self.cache = cache
+        self.cache_key = cache_key
+        self.pages = [None] * page_count
+        self.remaining = page_count
+        self.page_separator = page_separator
+        self.error = None
+        self.future = Future()
+        self._lock = threading.Lock()
+
+    def page_done(self, page_number, future):
+        with self._lock:
+            if future.cancelled():
+                self.error = self.error or Exception('cancelled')
+            elif future.exception() is not None:
+                self.error = self.error or future.exception()
+            else:
+                self.pages[page_number] = future.result()
+            self.remaining -= 1
+            if self.remaining > 0:
+                return
+
+        if self.error is not None:
+            self.future.set_exception(self.error)
+            return
+
+        try:
+            textkey = os.path.splitext(self.file_path)[0] + '.txt'
+            text = self.page_separator.join(self.pages)
+            write_text_file(textkey, text)
+            if self.cache is not None:
+                self.cache.set(*self.cache_key, text)
+            self.future.set_result(textkey)
+        except Exception as ex:
+            self.future.set_exception(ex)
+
+
+class OCREngine():
+
+    def __init__(self, workers=None, queue_size=None, tesseract_config=DEFAULT_TESSERACT_CONFIG, dpi=300, page_separator=PAGE_SEPARATOR, backend='auto',
+                 cache_path=None):
+        """
+        workers is the number of OCR processes (default: one per CPU). queue_size is the number of pages that can be
+        waiting or running at once before submit() blocks (default: 4 per worker). PDF pages are rendered at dpi.
+        backend is the OCR backend each worker uses, see service.ocr_backends.
+        cache_path is the SQLite database of OCR results (see service.ocr_cache), None to always OCR.
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size or self.workers * 4
+        self.tesseract_config = tesseract_config
+        self.backend = backend
+        self.dpi = dpi
+        self.page_separator = page_separator
+        self.cache = OCRCache(cache_path) if cache_path else None
+        self.settings = ocr_settings(tesseract_config, dpi, page_separator)
+
+        use_python_for_processes()
+
+        self._slots = threading.BoundedSemaphore(self.queue_size)
+        # spawned rather than forked: the workers are started on the first submit, from a watcher thread, and a
+        # forked worker would inherit whatever locks the other threads held at that moment (and could hang on them)
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+        print(f"{datetime.now()} OCR engine started with {self.workers} workers using {self.backend}")
+
+    def submit(self, file_path):
+        """
+        Queues every page of a file for OCR and returns a Future for the path of the text file.
+        Blocks while the queue is full.
+        """
+        cache_key = None
+        if self.cache is not None:
+            cache_key = (self.cache.hash_file(file_path), self.settings)
+            text = self.cache.get(*cache_key)
+            if text is not None:
+                return self._cached(file_path, text)
+
+        job = _OCRJob(file_path, count_pages(file_path), self.page_separator, self.cache, cache_key)
+        job.future.add_done_callback(lambda future: self._done(file_path, future))
+
+        for page_number in range(len(job.pages)):
+            self._slots.acquire()
+            try:
+                future = self._executor.submit(ocr_page, file_path, page_number, self.backend, self.tesseract_config, self.dpi)
+            except BaseException as ex:
+                self._slots.release()
+                # count the pages that will never be sent as failed, so the job still completes
+                for _ in range(page_number, len(job.pages)):
+                    failed = Future()
+                    failed.set_exception(ex)
+                    job.page_done(page_number, failed)
+                raise
+
+            future.add_done_callback(lambda future, page_number=page_number: self._page_done(job, page_number, future))
+
+        return job.future
+
+    def _cached(self, file_path, text):
+        # the file was OCR'd before, only write the text file if it has gone missing
+        textkey = os.path.splitext(file_path)[0] + '.txt'
+        if not os.path.exists(textkey):
+            write_text_file(textkey, text)
+            print(f"{datetime.now()} Saved text file {textkey} from the OCR cache")
+        else:
+            print(f"{datetime.now()} Skipped {file_path}, already OCR'd")
+
+        future = Future()
+        future.set_result(textkey)
+        return future
+
+    def _page_done(self, job, page_number, future):
+        self._slots.release()
+        job.page_done(page_number, future)
+
+    def _done(self, file_path, future):
+        ex = future.exception()
+        if ex is not None:
+            print(f'{datetime.now()} Error processing {file_path}: {ex}')
+        else:
+            print(f"{datetime.now()} Saved text file {future.result()}")
+
+    def shutdown(self, wait=True):
+        """
+        Stops the workers. With wait, the files already queued are finished first, otherwise they are dropped.
+        """
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
+        if self.cache is not None and wait:
+            self.cache.close()
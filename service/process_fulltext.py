@@ -2,24 +2,38 @@
 from watchdog.events import FileSystemEventHandler
 from datetime import datetime
 import os
-import pysolr
+from service.solr_indexer import get_solr_indexer
 
 # This class handles the file system events for the folder being watched
 class TextFileHandler(FileSystemEventHandler,):
 
+    # the files the handler passes to Process
+    extensions = ('.txt', '.did')
+
     def __init__(self, config):
         
         self.config  =config
 
+        # documents are sent to solr in batches, by an indexer shared by every handler using the same solr url.
+        # The optional "solr_settings" are passed to the indexer (batch_size, batch_bytes, flush_interval, commit_within).
+        self.indexer = get_solr_indexer(config['solrUrl'], **config.get('solr_settings', {}))
+
     
     def Process(self,file_path):
+        """
+        Queues the file for solr. Returns False if it couldn't be read, otherwise a Future that is done once
+        solr has the document.
+        """
         try:
             if file_path.lower().endswith('.txt'):
-                self.ProcessText(file_path)
+                return self.ProcessText(file_path)
             elif file_path.lower().endswith('.did'):
-                self.ProcessDID(file_path)
+                return self.ProcessDID(file_path)
         except Exception as ex:
             print(f'{datetime.now()} Error: {ex.args[0]}')
+            return False
+
+        return True
         
     def ProcessText(self, file_path):
 
@@ -30,9 +44,6 @@ class TextFileHandler(FileSystemEventHandler,):
             #for text files, read all the text into a string
             with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
                 full_text = f.read()
-
-                #send the text to solr
-                solr = pysolr.Solr(self.config['solrUrl']  , always_commit=True, timeout=10)
                 
                 solrId = file_path
                 
@@ -43,16 +54,17 @@ class TextFileHandler(FileSystemEventHandler,):
                     print(f"{datetime.now()} Solr ID: {solrId}")     
                 
                 #create the solr document
-                content =[{
+                content ={
                         "id": solrId,
                         "content": full_text, 
-                    }]
+                    }
                 
-                
-                solr.add(content)
+                #queue the document for solr
+                return self.indexer.add(content)
 
         except Exception as ex:
             print(f'{datetime.now()} Error: {ex.args[0]}')
+            return False
 
     def ProcessDID(self, file_path):
 
@@ -64,9 +76,6 @@ class TextFileHandler(FileSystemEventHandler,):
             with open(file_path, 'r') as f:
                 
                 did_content = [line.strip().lower() for line in f.readlines()]
-
-                #send the text to solr
-                solr = pysolr.Solr(self.config['solrUrl']  , always_commit=True, timeout=10)
             
                 solrId = file_path
                 
@@ -77,15 +86,18 @@ class TextFileHandler(FileSystemEventHandler,):
                     print(f"{datetime.now()} Solr ID: {solrId}")
                     
                 #create the solr document
-                content =[{
+                content ={
                         "id": solrId,
                         "didcontent": did_content, 
-                    }]
+                    }
                 
-                
-                solr.add(content)
+                #queue the document for solr
+                return self.indexer.add(content)
 
         except Exception as ex:
             print(f'{datetime.now()} Error: {ex.args[0]}')
+            return False
 
-    
+    def stop(self):
+        # send whatever is still waiting
+        self.indexer.stop()
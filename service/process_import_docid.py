@@ -4,24 +4,31 @@
 # If the barcode is not found, the file is not imported.
 ############################################################################################################
 
-from PIL import Image
 from datetime import datetime
-from pyzbar.pyzbar import decode
-import cv2
-import numpy as np
-import tempfile
-import sys
-import os
 
 import utils.AquariusImaging as AquariusImaging
+from utils.TIFFSplitter import TIFFSplitter
+from utils.BarcodeScanner import BarcodeScanner, is_docid
 
 # This class handles importing files.
 class ImportProcessorBarcodeDocID():
+
+    # the files the handler passes to Process
+    extensions = ('.tif', '.jpg')
     
     def __init__(self, config):
 
         self.config = config
 
+        # split pages are kept in memory up to this size, larger ones go to a temporary file.
+        self.page_spill_size = config.get('page_spill_size', AquariusImaging.PAGE_SPILL_SIZE)
+
+        # barcode_zones limits where the docID barcode is looked for (see utils.BarcodeScanner), the
+        # whole page is still searched if it isn't found there.
+        self.barcode_scanner = BarcodeScanner(zones=config.get('barcode_zones'),
+                                              scales=config.get('barcode_scales', (0.5,)),
+                                              validator=is_docid)
+
         # Authenticate to Aquarius Imaging
         self.aqApi =  AquariusImaging.AquariusWebAPIWrapper(config['server'])                     
         self.aqApi.authenticate(config['username'], config['password'])
@@ -33,76 +40,33 @@ class ImportProcessorBarcodeDocID():
             raise Exception(f'{datetime.now()} Error authenticating to Aquarius Imaging')
 
     def Process(self, file_path):
+        """
+        Imports the file into the document in its barcode. Returns False if it wasn't imported.
+        """
         try:
-            if file_path.lower().endswith('.tif') or file_path.lower().endswith('.jpg'):
+            if file_path.lower().endswith(self.extensions):
                 print(f"{datetime.now()} Processing {file_path}")
                 
-                with Image.open(file_path) as img:
-                    #img_cv = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
-                    # Check if the image is in black and white (1-bit per pixel)
-                    if img.mode == '1':
-                        print("Detected black and white TIFF, converting to grayscale")
-                        # Convert to grayscale mode
-                        img = img.convert('L')
-                    
-                    # Convert the image to a numpy array
-                    img_np = np.array(img)
-                    
-                    # Check for valid image data
-                    if img_np is None or img_np.size == 0:
-                        print("Image data is empty after conversion to numpy array")
-                        return
-                    
-                    # If the image is already grayscale, no need to convert color
-                    if img_np.ndim == 2:  # If it's already a single channel
-                        img_cv = img_np  # No color conversion needed for grayscale
-                    else:
-                        # Convert from RGB to BGR for OpenCV compatibility
-                        img_cv = cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR)
-                    
-                    # Read the barcode from the image
-                    barcodes = decode(img_cv)
-                    doc_id = None
-                    for barcode in barcodes:
-                        barcode_data = barcode.data.decode('utf-8')
-                        barcode_type = barcode.type
-                        print(f"Found {barcode_type} barcode: {barcode_data}")
-                        if len(barcode_data) == 8:
-                            doc_id = barcode_data
-                            
-                            break
+                # Read the barcode from the first page, stopping at the first one that looks like a docID
+                barcodes = self.barcode_scanner.scan_file(file_path)
+                doc_id = None
+                for barcode in barcodes:
+                    print(f"Found {barcode.type} barcode: {barcode.data}")
+                    doc_id = barcode.data
                     
                 #doc_id = 'W2SQXH6W'
                 if doc_id:
                     if (file_path.lower().endswith('.tif')):                    
-                        temp_files = []
-                        # Create a temporary directory to store the single-page TIFF files.
-                        # When we exit this scope, the files are automatically deleted.
-                        with tempfile.TemporaryDirectory() as temp_dir:
-                        
-                            # Open the multipage TIFF file
-                            tiff_file = []
+                        # Split the multipage TIFF without decoding it, into memory buffers
+                        # that are released when we exit this scope.
+                        with TIFFSplitter(file_path, spill_size=self.page_spill_size) as splitter:
+                            pages = splitter.get_pages()
 
-                            #tiff_file = cv2.imread(file_path, cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR)
-                            retbool, tiff_file = cv2.imreadmulti(mats=tiff_file,
-                                                        filename=file_path,
-                                                        flags=cv2.IMREAD_ANYCOLOR)
-                            
-                            # Iterate over each page in the TIFF file
-                            if len(tiff_file) > 0:
-                                for i in range(len(tiff_file)):
-                                                                                                                    
-                                    # Create a filename for the single-page TIFF file
-                                    output_file = os.path.join(temp_dir, f"page_{i}.tif")
+                            for page in pages:
+                                print(f'{datetime.now()} Adding {page.name} to {doc_id}')
 
-                                    # Save the current page to the output file
-                                    cv2.imwrite(output_file, tiff_file[i])
-                                    #file_size = os.path.getsize( tiff_file[i].filename)
-                                    print(f'{datetime.now()} Adding {output_file} to {doc_id}')
-                                    
-                                    temp_files.append(output_file)
-
-                                if (self.aqApi.AddPagesToDocument(doc_id, temp_files).status_code != 200):
+                            if pages:
+                                if (self.aqApi.AddPagesToDocument(doc_id, pages).status_code != 200):
                                     raise Exception(f'Error uploading files:')
                     else:
                         #if this is not a tif file, just upload it.
@@ -113,9 +77,15 @@ class ImportProcessorBarcodeDocID():
                     #delete the file.
                     print(f"{datetime.now()} Deleting {file_path}")
                     #os.remove(file_path)
+                else:
+                    # not imported, so try again next time the folder is scanned
+                    return False
             
         except Exception as ex:
             print(f'{datetime.now()} Error: {ex.args[0]}')
+            return False
+
+        return True
 
 
     # property to expose self.config
@@ -2,38 +2,51 @@
 # This class runs the ocr process on the image files.
 # It uses the pytesseract library to extract text from the image files.
 # The extracted text is saved to a text file with the same name as the image file.
+# The OCR itself runs on an OCREngine process pool, so files (and the pages of multi-page TIFFs
+# and PDFs) are OCR'd in parallel.
 ##################################################################################################
 
-import pytesseract
-from PIL import Image
 from datetime import datetime
+from service.ocr_engine import OCREngine, OCR_EXTENSIONS
 
 # This class handles importing files.
 class OCRProcessor():
+
+    # the files the handler passes to Process
+    extensions = OCR_EXTENSIONS
     
     def __init__(self, config):
 
         self.config = config
+
+        # Processors for several folders can share one engine by passing it in the config as "ocr_engine",
+        # otherwise the processor starts its own, sized by "ocr_workers" and "ocr_queue_size", using the
+        # "ocr_backend" OCR backend (see service.ocr_backends) and the "ocr_cache_path" OCR cache.
+        self.engine = config.get('ocr_engine')
+        self.owns_engine = self.engine is None
+        if self.owns_engine:
+            self.engine = OCREngine(config.get('ocr_workers'), config.get('ocr_queue_size'), backend=config.get('ocr_backend', 'auto'),
+                                    cache_path=config.get('ocr_cache_path'))
    
     def Process(self, file_path):
+        """
+        Queues the file for OCR. Returns the Future for its text file, or False if it couldn't be queued.
+        """
 
-       #run the tessaract OCR process
+       #queue the file for the tessaract OCR process
         try:
-            if file_path.lower().endswith('.tif') or file_path.lower().endswith('.jpg'):
+            if file_path.lower().endswith(OCR_EXTENSIONS):
                 print(f"{datetime.now()} Processing  {file_path}")
                 
-                img = Image.open(file_path)
-
-                #run the ocr
-                config='-c preserve_interword_spaces=1 --oem {} --psm {} -l {}'.format('3','1','eng+spa')
-                ocr_text = pytesseract.image_to_string(img, config=config).strip()
-
-
-                #save the text file
-                textkey = file_path[0:-4] + '.txt'
-                with open(textkey, 'w') as f:
-                    f.write(ocr_text)
-                    print(f"{datetime.now()} Saved text file {textkey}")
+                return self.engine.submit(file_path)
 
         except Exception as ex:
             print(f'{datetime.now()} Error: {ex.args[0]}')
+            return False
+
+        return True
+
+    def stop(self):
+        # finish the files already queued
+        if self.owns_engine:
+            self.engine.shutdown()
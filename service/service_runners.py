@@ -0,0 +1,214 @@
+########################################################################################################################
+#
+# Purpose: The runners build and run the processors of each service (import, OCR, unified) on a GenericWatcher.
+# A service's folders are split into units (one per watched folder), so the supervisor can run them in several
+# processes; each runner runs the units it is given. The runners don't depend on the Windows service framework, so
+# they run the same way under the Windows service, under the supervisor, or from the command line.
+#
+########################################################################################################################
+
+from abc import ABC, abstractmethod
+import multiprocessing
+import os
+import sys
+import threading
+from service.generic_watcher import GenericWatcher
+
+
+def use_python_for_processes():
+    """
+    Makes multiprocessing start its processes with python.exe when running as a Windows service, where
+    sys.executable is pythonservice.exe, which can't start them. Does nothing anywhere else.
+    """
+    if sys.platform == 'win32' and os.path.basename(sys.executable).lower().startswith('pythonservice'):
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'python.exe'))
+
+
+class WatcherRunner(ABC):
+    """
+    Runs a GenericWatcher with the processors for some of a service's units. processes is the number of runners
+    sharing the machine, so a runner can take its share of resources such as OCR worker processes.
+    """
+
+    def __init__(self, units=None, processes=1):
+        self.units = list(units) if units is not None else self.all_units()
+        self.processes = processes
+        self.watcher = None
+        self._stop_lock = threading.Lock()
+
+    @classmethod
+    @abstractmethod
+    def all_units(cls):
+        """
+        Returns the units (picklable, usually the watched folders) the service's folders are split into.
+        """
+
+    @abstractmethod
+    def create_processors(self):
+        """
+        Returns the processors for this runner's units.
+        """
+
+    def watcher_settings(self):
+        # keyword arguments for the GenericWatcher
+        return {}
+
+    def start(self):
+        self.watcher = GenericWatcher(self.create_processors(), **self.watcher_settings())
+        self.watcher.start()
+
+    def run(self):
+        self.watcher.run()
+
+    def stop(self):
+        # can be called again (or from another thread) while stopping, the second call waits for the first
+        with self._stop_lock:
+            if self.watcher is not None:
+                self.watcher.stop()
+            self.close()
+
+    def close(self):
+        pass
+
+
+class ImportRunner(WatcherRunner):
+
+    @classmethod
+    def all_units(cls):
+        import service.config_import as config_import
+        return list(config_import.folders_to_watch)
+
+    def watcher_settings(self):
+        import service.config_import as config_import
+        return {'manifest_use_hash': config_import.manifest_use_hash}
+
+    def create_processors(self):
+        import service.config_import as config_import
+        from service.process_import_docid import ImportProcessorBarcodeDocID
+
+        processors=[]
+        for folder in self.units:
+        # Create a processor instance and inject the folder and flag into the handler.
+            processors.append(ImportProcessorBarcodeDocID({
+                "folder_to_watch": folder,
+                "process_existing_files": config_import.folders_to_watch[folder],
+                "server": config_import.aquarius_api_url,
+                "username": config_import.username,
+                "password": config_import.password,
+                "page_spill_size": config_import.page_spill_size,
+                "barcode_zones": config_import.barcode_zones,
+                "workers": config_import.workers,
+                "queue_size": config_import.queue_size
+            }))
+        return processors
+
+
+class OCRRunner(WatcherRunner):
+
+    def __init__(self, units=None, processes=1):
+        super().__init__(units, processes)
+        self.ocr_engine = None
+
+    @classmethod
+    def all_units(cls):
+        import service.config_ocr as config_ocr
+        return list(config_ocr.folders_to_watch)
+
+    def ocr_folders(self):
+        return self.units
+
+    def watcher_settings(self):
+        import service.config_ocr as config_ocr
+        return {'manifest_use_hash': config_ocr.manifest_use_hash}
+
+    def create_ocr_engine(self):
+        import service.config_ocr as config_ocr
+        from service.ocr_engine import OCREngine
+
+        # one pool of OCR processes shared by all the folders of this runner, with its share of the CPUs
+        workers = max(1, (config_ocr.ocr_workers or os.cpu_count() or 1) // self.processes)
+        return OCREngine(workers, config_ocr.ocr_queue_size, backend=config_ocr.ocr_backend, cache_path=config_ocr.ocr_cache_path)
+
+    def create_ocr_processors(self):
+        import service.config_ocr as config_ocr
+        from service.process_ocr import OCRProcessor
+
+        processors=[]
+        folders = self.ocr_folders()
+        if folders:
+            self.ocr_engine = self.create_ocr_engine()
+
+        for folder in folders:
+        # Create a processor instance and inject the folder and flag into the handler.
+            processors.append(OCRProcessor({
+                "folder_to_watch": folder,
+                "process_existing_files": config_ocr.folders_to_watch[folder],
+                "ocr_engine": self.ocr_engine,
+                "workers": config_ocr.workers,
+                "queue_size": config_ocr.queue_size
+            }))
+        return processors
+
+    def create_processors(self):
+        return self.create_ocr_processors()
+
+    def close(self):
+        if self.ocr_engine is not None:
+            self.ocr_engine.shutdown()  # finish the files already queued for OCR
+            self.ocr_engine = None
+
+
+class UnifiedRunner(OCRRunner):
+
+    @classmethod
+    def all_units(cls):
+        import service.config_ocr as config_ocr
+        import service.config_fulltext_index as config_fulltext_index
+
+        units = [('ocr', folder) for folder in config_ocr.folders_to_watch]
+        if config_fulltext_index.folder_solr_mapping:
+            units += [('fulltext', folder) for folder in config_fulltext_index.folder_solr_mapping]
+        return units
+
+    def ocr_folders(self):
+        return [folder for kind, folder in self.units if kind == 'ocr']
+
+    def watcher_settings(self):
+        import service.config_ocr as config_ocr
+        import service.config_fulltext_index as config_fulltext_index
+        # one manifest for both kinds of folder
+        return {'manifest_use_hash': config_ocr.manifest_use_hash or config_fulltext_index.manifest_use_hash}
+
+    def create_processors(self):
+        import service.config_fulltext_index as config_fulltext_index
+        from service.process_fulltext import TextFileHandler
+
+        processors = self.create_ocr_processors()
+
+        for kind, folder_to_watch in self.units:
+            if kind != 'fulltext':
+                continue
+
+            print(f"Watching folder: {folder_to_watch}")
+
+            mapping = config_fulltext_index.folder_solr_mapping[folder_to_watch]
+            solrUrl = mapping["solrUrl"]
+            path_replacement_pairs = mapping["path_replacement_pairs"]
+
+            processors.append(TextFileHandler({
+                "folder_to_watch": folder_to_watch,
+                "process_existing_files": config_fulltext_index.process_existing_text_files,
+                "solrUrl": solrUrl,
+                "path_replacement_pairs": path_replacement_pairs,
+                "solr_settings": config_fulltext_index.solr_settings,
+                "workers": config_fulltext_index.workers,
+                "queue_size": config_fulltext_index.queue_size
+            }))
+        return processors
+
+
+RUNNERS = {
+    'import': ImportRunner,
+    'ocr': OCRRunner,
+    'unified': UnifiedRunner,
+}
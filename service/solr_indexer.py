@@ -0,0 +1,211 @@
+##################################################################################################
+# This class sends documents to Solr in batches from a background thread, over one client (and so
+# one pool of connections) per Solr URL. Documents are flushed when batch_size documents or
+# batch_bytes of text are waiting, or flush_interval seconds after the first one arrived.
+# Instead of a hard commit per document, Solr is asked to make them searchable within
+# commit_within milliseconds (commitWithin), which lets it commit many batches at once.
+# A batch that fails because Solr can't be reached (or has a server error) is kept and sent again;
+# once max_pending documents are waiting, add() blocks until Solr catches up. A batch that Solr
+# rejects (a 4xx, such as a bad field or a document that is too large) is split in halves until
+# the documents it rejects are found, and those are logged and dropped.
+# add() returns a Future for each document, which is done once Solr has accepted the document, and
+# fails if Solr rejected it or the indexer stopped before it could be sent.
+##################################################################################################
+
+from concurrent.futures import Future
+from datetime import datetime
+import re
+import threading
+import time
+import pysolr
+
+MB = 1024 * 1024
+
+# statuses that say nothing about the documents themselves
+RETRY_STATUSES = (408, 429)
+
+
+def document_size(document):
+    # roughly the number of bytes the document adds to the request
+    return sum(len(value) if isinstance(value, str) else sum(len(str(item)) for item in value) if isinstance(value, list) else len(str(value))
+               for value in document.values())
+
+
+def is_retryable(error):
+    """
+    Returns True if sending the same documents again may work: Solr couldn't be reached, timed out or had a server
+    error. Anything else means Solr (or pysolr) rejected the documents.
+    """
+    if not isinstance(error, pysolr.SolrError):
+        return False
+    match = re.search(r'\(HTTP (\d+)\)', str(error))
+    if match is None:
+        # connection errors and timeouts
+        return True
+    status = int(match.group(1))
+    return status >= 500 or status in RETRY_STATUSES
+
+
+class SolrIndexer():
+
+    def __init__(self, solr_url, batch_size=500, batch_bytes=8 * MB, flush_interval=5, commit_within=10000, timeout=30, max_pending=None):
+        self.solr_url = solr_url
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.commit_within = commit_within
+        self.max_pending = max_pending or batch_size * 20
+
+        self.solr = pysolr.Solr(solr_url, always_commit=False, timeout=timeout)
+
+        self._pending = []
+        self._pending_bytes = 0
+        self._first_pending = None
+        self._stopping = False
+        self._stopped = threading.Event()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def add(self, document):
+        """
+        Queues a document to be sent to Solr. Returns a Future that is done once Solr has accepted it.
+        """
+        size = document_size(document)
+        future = Future()
+        with self._condition:
+            while len(self._pending) >= self.max_pending and not self._stopping:
+                self._condition.wait()
+
+            self._start()
+            if not self._pending:
+                self._first_pending = time.monotonic()
+            self._pending.append((document, size, future))
+            self._pending_bytes += size
+            self._condition.notify_all()
+        return future
+
+    def _start(self):
+        # the thread is started on first use, and again if the indexer is used after stop()
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping = False
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='solr-indexer', daemon=True)
+            self._thread.start()
+
+    def _ready(self):
+        return (len(self._pending) >= self.batch_size
+                or self._pending_bytes >= self.batch_bytes
+                or (self._pending and time.monotonic() - self._first_pending >= self.flush_interval))
+
+    def _run(self):
+        failures = 0
+        while True:
+            with self._condition:
+                while not self._stopping and not self._ready():
+                    timeout = self.flush_interval - (time.monotonic() - self._first_pending) if self._pending else None
+                    self._condition.wait(timeout)
+
+                if not self._pending:
+                    return
+                batch = self._take_batch()
+
+            batch = self._send(batch)
+            if not batch:
+                failures = 0
+            else:
+                # put what couldn't be sent back in front, and wait before trying again
+                with self._condition:
+                    self._pending[0:0] = batch
+                    self._pending_bytes += sum(size for _, size, _ in batch)
+                    self._first_pending = time.monotonic()
+                    if self._stopping:
+                        print(f'{datetime.now()} Stopping with {len(self._pending)} documents not sent to {self.solr_url}')
+                        unsent = self._pending
+                        self._pending = []
+                        self._pending_bytes = 0
+                        self._first_pending = None
+                        self._condition.notify_all()
+                    else:
+                        unsent = None
+                if unsent is not None:
+                    # the files are processed again, see service.generic_handler and service.job_store
+                    for _, _, future in unsent:
+                        future.set_exception(Exception(f'Stopped before the document was sent to {self.solr_url}'))
+                    return
+                failures += 1
+                self._stopped.wait(min(60, 2 ** failures))
+
+    def _take_batch(self):
+        count, size = 0, 0
+        while count < len(self._pending) and count < self.batch_size and (count == 0 or size + self._pending[count][1] <= self.batch_bytes):
+            size += self._pending[count][1]
+            count += 1
+
+        batch = self._pending[:count]
+        del self._pending[:count]
+        self._pending_bytes -= size
+        self._first_pending = time.monotonic() if self._pending else None
+        self._condition.notify_all()
+        return batch
+
+    def _send(self, batch):
+        """
+        Sends a batch and returns the documents to send again later: all of them if Solr couldn't take them,
+        none once they were sent or rejected.
+        """
+        try:
+            self.solr.add([document for document, _, _ in batch], commit=False, commitWithin=self.commit_within)
+        except Exception as ex:
+            if is_retryable(ex):
+                print(f'{datetime.now()} Error sending {len(batch)} documents to {self.solr_url}: {ex}')
+                return batch
+
+            if len(batch) == 1:
+                print(f"{datetime.now()} Solr rejected {batch[0][0].get('id')}, dropping it: {ex}")
+                batch[0][2].set_exception(ex)
+                return []
+
+            # find the documents Solr rejects by sending each half on its own
+            middle = len(batch) // 2
+            return self._send(batch[:middle]) + self._send(batch[middle:])
+
+        print(f"{datetime.now()} Sent {len(batch)} documents to {self.solr_url}")
+        for _, _, future in batch:
+            future.set_result(True)
+        return []
+
+    def stop(self):
+        """
+        Sends everything that is waiting and stops the background thread.
+        """
+        with self._condition:
+            self._stopping = True
+            self._stopped.set()
+            self._condition.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+
+_indexers = {}
+_indexers_lock = threading.Lock()
+
+
+def get_solr_indexer(solr_url, **settings):
+    """
+    Returns the SolrIndexer shared by everything in this process that indexes into solr_url.
+    The settings are used by whichever caller creates it first.
+    """
+    key = solr_url.rstrip('/')
+    with _indexers_lock:
+        indexer = _indexers.get(key)
+        if indexer is None:
+            indexer = _indexers[key] = SolrIndexer(solr_url, **settings)
+        return indexer
+
+
+def stop_all_indexers():
+    with _indexers_lock:
+        indexers = list(_indexers.values())
+    for indexer in indexers:
+        indexer.stop()
@@ -0,0 +1,196 @@
+########################################################################################################################
+#
+# Purpose: The supervisor runs a service (import, OCR or unified) in several worker processes, so the watched folders
+# are spread across the CPUs instead of sharing one Python process. The folders of the service (see
+# service.service_runners) are split between the workers, and each worker runs a GenericWatcher over its share.
+# A worker that crashes is started again, waiting longer each time it crashes soon after starting. On stop, the
+# workers are asked to finish what they have queued, and are only killed if they don't within stop_timeout seconds.
+#
+# Run it in the foreground (Ctrl+C or SIGTERM stops it):
+#
+#   python -m service.supervisor import|ocr|unified [--processes N]
+#
+# The Windows services run the same supervisor.
+#
+########################################################################################################################
+
+from datetime import datetime
+import argparse
+import inspect
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+from service.service_runners import RUNNERS, use_python_for_processes
+
+
+def run_worker(service, units, processes, stop_connection):
+    """
+    Runs the runner of a service over some of its units, until the supervisor sends stop on stop_connection.
+    """
+    # Ctrl+C reaches the whole process group, the supervisor decides when the workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    runner = RUNNERS[service](units, processes)
+    runner.start()
+
+    # stop from a thread, so the watcher's run loop ends and the main thread returns
+    def stop_when_asked():
+        try:
+            stop_connection.recv()
+        except EOFError:
+            pass
+        runner.stop()
+    threading.Thread(target=stop_when_asked, name='stopper', daemon=True).start()
+
+    runner.run()
+    runner.stop()  # returns once the stopper has finished
+
+
+class Worker:
+
+    def __init__(self, index, units):
+        self.index = index
+        self.units = units
+        self.process = None
+        self.connection = None
+        self.started_at = None
+        self.restart_delay = 0
+        self.restart_at = None
+
+
+class Supervisor:
+
+    def __init__(self, service, processes=None, restart_delay=1, max_restart_delay=60, stable_time=60, stop_timeout=300):
+        """
+        processes is the number of worker processes, by default one per unit up to the number of CPUs.
+        A worker that crashes is restarted after restart_delay seconds, doubled (up to max_restart_delay) each time it
+        crashes within stable_time seconds of starting.
+        """
+        if service not in RUNNERS:
+            raise Exception(f'Unknown service {service}, expected one of {", ".join(RUNNERS)}')
+        if inspect.isabstract(RUNNERS[service]):
+            raise Exception(f'The runner for the {service} service does not implement {", ".join(sorted(RUNNERS[service].__abstractmethods__))}')
+
+        self.service = service
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stable_time = stable_time
+        self.stop_timeout = stop_timeout
+
+        units = RUNNERS[service].all_units()
+        if not units:
+            raise Exception(f'No folders are configured for the {service} service')
+
+        self.processes = max(1, min(processes or os.cpu_count() or 1, len(units)))
+        self.workers = [Worker(i, units[i::self.processes]) for i in range(self.processes)]
+
+        use_python_for_processes()
+
+        # a pipe to each worker rather than a shared Event, which a worker killed while waiting on it would break
+        self._stop_event = threading.Event()
+        self._stopped = threading.Event()
+        # no worker is started once stop() has begun
+        self._lock = threading.Lock()
+
+    def _start_worker(self, worker):
+        reader, worker.connection = multiprocessing.Pipe(duplex=False)
+        # not a daemon, so the worker can start its own processes (the OCR engine)
+        worker.process = multiprocessing.Process(target=run_worker, name=f'{self.service}-{worker.index}',
+                                                 args=(self.service, worker.units, self.processes, reader))
+        worker.process.start()
+        reader.close()
+        worker.started_at = time.monotonic()
+        worker.restart_at = None
+        print(f'{datetime.now()} Started worker {worker.process.name} (pid {worker.process.pid}) for {worker.units}')
+
+    def start(self):
+        print(f'{datetime.now()} Starting the {self.service} service with {self.processes} worker processes')
+        for worker in self.workers:
+            self._start_worker(worker)
+
+    def _check(self, worker):
+        now = time.monotonic()
+        if worker.restart_at is not None:
+            if now >= worker.restart_at:
+                self._start_worker(worker)
+            return
+
+        if worker.process.is_alive():
+            return
+
+        # crashed: restart it, waiting longer if it keeps crashing soon after starting
+        if now - worker.started_at < self.stable_time:
+            worker.restart_delay = min(self.max_restart_delay, max(self.restart_delay, worker.restart_delay * 2))
+        else:
+            worker.restart_delay = self.restart_delay
+        worker.restart_at = now + worker.restart_delay
+        print(f'{datetime.now()} Worker {worker.process.name} exited with code {worker.process.exitcode}, '
+              f'restarting in {worker.restart_delay} seconds')
+
+    def run(self, check_interval=1):
+        """
+        Watches the workers until stop() is called, restarting the ones that exit.
+        """
+        while not self._stop_event.wait(check_interval):
+            with self._lock:
+                if self._stop_event.is_set():
+                    break
+                for worker in self.workers:
+                    self._check(worker)
+        self._stopped.wait()
+
+    def stop(self):
+        """
+        Asks the workers to finish what they have queued and waits for them.
+        """
+        with self._lock:
+            if self._stop_event.is_set():
+                return
+            print(f'{datetime.now()} Stopping the {self.service} service')
+            self._stop_event.set()
+
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                try:
+                    worker.connection.send('stop')
+                except OSError:
+                    pass
+
+        deadline = time.monotonic() + self.stop_timeout
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            worker.process.join(max(0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                print(f'{datetime.now()} Worker {worker.process.name} did not stop in time, killing it')
+                worker.process.kill()
+                worker.process.join()
+
+        print(f'{datetime.now()} Stopped the {self.service} service')
+        self._stopped.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m service.supervisor', description='Runs a watcher service in the foreground.')
+    parser.add_argument('service', choices=sorted(RUNNERS))
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes (default: one per folder, up to the number of CPUs)')
+    args = parser.parse_args()
+
+    supervisor = Supervisor(args.service, args.processes)
+
+    # stop on Ctrl+C and SIGTERM (from the main thread, the handlers only ask)
+    def handle_signal(signum, frame):
+        threading.Thread(target=supervisor.stop, name='stop').start()
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    supervisor.start()
+    supervisor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+########################################################################################################################
+#
+# Purpose: This class sits between a FileHandler and its processor. Files are put on a bounded queue and processed by
+# a pool of worker threads, so a slow processor never holds up the file system events, and several files can be
+# processed at once. A file that is already waiting in the queue isn't queued again, and a file that is put while it is
+# being processed is processed again once that is done (it may have changed). When the queue is full, put() waits for
+# the workers to catch up. stop() processes everything that was already queued before returning.
+#
+########################################################################################################################
+
+from datetime import datetime
+import queue
+import threading
+
+
+class WorkQueue:
+
+    def __init__(self, process, workers=1, queue_size=1000, name='worker'):
+        """
+        process is called with each file path, on one of workers threads.
+        """
+        self.process = process
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=queue_size)
+        # files waiting or being processed, the ones being processed, and the ones to process again after that
+        self._queued = set()
+        self._running = set()
+        self._again = set()
+        self._lock = threading.Lock()
+        self._stopping = False
+
+        self._threads = [threading.Thread(target=self._run, name=f'{name}-{i}', daemon=True) for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, file_path):
+        """
+        Queues a file, waiting while the queue is full. Returns False if the file was already queued
+        or the queue is stopping.
+        """
+        with self._lock:
+            if self._stopping:
+                return False
+            if file_path in self._running and file_path not in self._again:
+                self._again.add(file_path)
+                return True
+            if file_path in self._queued:
+                return False
+            self._queued.add(file_path)
+
+        self._queue.put(file_path)
+        return True
+
+    def _run(self):
+        while True:
+            file_path = self._queue.get()
+            try:
+                if file_path is None:
+                    return
+
+                with self._lock:
+                    self._running.add(file_path)
+
+                while True:
+                    try:
+                        self.process(file_path)
+                    except Exception as ex:
+                        print(f'{datetime.now()} Error: {str(ex)}')
+
+                    with self._lock:
+                        if file_path in self._again:
+                            self._again.discard(file_path)
+                            continue
+                        self._running.discard(file_path)
+                        self._queued.discard(file_path)
+                        break
+            finally:
+                self._queue.task_done()
+
+    def defer(self, file_paths):
+        """
+        Called after stop() with files that weren't ready to be processed. The queue is in memory, so they can only
+        be reported (the next startup scan finds them, if the folder is scanned).
+        """
+        for file_path in file_paths:
+            print(f'{datetime.now()} Not processed before stopping: {file_path}')
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def stop(self):
+        """
+        Stops taking new files, waits for the queued ones to be processed and stops the workers.
+        """
+        with self._lock:
+            if self._stopping:
+                return
+            self._stopping = True
+
+        # one marker per worker, after everything already queued
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
@@ -0,0 +1,12 @@
+import importlib.util
+import unittest
+
+
+def require_modules(*names):
+    """
+    Skips the calling test module unless the packages it needs are installed. Call it before importing the code
+    under test.
+    """
+    missing = [name for name in names if importlib.util.find_spec(name) is None]
+    if missing:
+        raise unittest.SkipTest(f'{", ".join(missing)} not installed')
@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from tests import require_modules
+
+require_modules('requests', 'magic', 'pandas', 'tifftools')
+
+from utils.AquariusDownloader import CrossRefDataWriter, DownloadJournal
+
+
+class DownloadJournalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.inputFile = os.path.join(self.folder, 'GridViewExport.csv')
+        self.writers = []
+
+    def tearDown(self):
+        for writer in self.writers:
+            writer.Close()
+            shutil.rmtree(writer.outputPath, ignore_errors=True)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def writer(self, uniqueIdentifier):
+        writer = CrossRefDataWriter(self.inputFile, uniqueIdentifier)
+        self.writers.append(writer)
+        return writer
+
+    def test_new_journal_starts_with_the_documents_in_the_cross_reference_file(self):
+        # a sequential run without a journal downloaded two documents
+        writer = self.writer('first')
+        writer.WriteDocument('doc1', [(1, 'doc11.tif'), (2, 'doc12.tif')])
+        writer.WriteDocument('doc2', [(1, 'doc21.tif')])
+
+        journal = DownloadJournal(self.inputFile, self.writer('second').DocumentIDs())
+        journal.Close()
+
+        journal = DownloadJournal(self.inputFile)
+        self.assertTrue(journal.IsComplete('doc1'))
+        self.assertTrue(journal.IsComplete('doc2'))
+        self.assertFalse(journal.IsComplete('doc3'))
+        journal.Close()
+
+    def test_existing_journal_is_not_seeded_again(self):
+        journal = DownloadJournal(self.inputFile)
+        journal.Complete('doc1')
+        journal.Close()
+
+        journal = DownloadJournal(self.inputFile, {'doc2'})
+        self.assertTrue(journal.IsComplete('doc1'))
+        self.assertFalse(journal.IsComplete('doc2'))
+        journal.Close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from tests import require_modules
+
+require_modules('requests', 'magic')
+
+import requests
+
+from utils.AquariusImaging import AquariusWebAPIWrapper, RetryPolicy
+
+
+class FakePageResponse:
+    # a streamed page whose connection can break off after the first chunk
+
+    def __init__(self, chunks, fail=False, status_code=200):
+        self.status_code = status_code
+        self.headers = {'Content-Disposition': 'attachment; filename=page.tif'}
+        self.url = 'http://aquarius/api/DocPages/doc/1'
+        self.chunks = chunks
+        self.fail = fail
+        self.closed = False
+
+    def iter_content(self, chunk_size=None):
+        for chunk in self.chunks:
+            yield chunk
+            if self.fail:
+                raise requests.exceptions.ChunkedEncodingError('connection reset')
+
+    def close(self):
+        self.closed = True
+
+
+class SavePageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.api = AquariusWebAPIWrapper('http://aquarius', throttle=False, background_token_refresh=False,
+                                         retry_policy=RetryPolicy(max_attempts=3, backoff_base=0, jitter=False))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_broken_download_is_requested_again(self):
+        responses = [FakePageResponse([b'half'], fail=True), FakePageResponse([b'whole', b' page'])]
+        self.api.GetPage = lambda docID, pageCounter, type, stream=False: responses.pop(0)
+
+        filepath = os.path.join(self.folder, 'page.tif')
+        response, saved = self.api.SavePage('doc', 1, 'image', lambda response: filepath)
+
+        self.assertEqual(saved, filepath)
+        with open(filepath, 'rb') as f:
+            self.assertEqual(f.read(), b'whole page')
+        # no partial files are left behind
+        self.assertEqual(os.listdir(self.folder), ['page.tif'])
+
+    def test_gives_up_after_max_attempts(self):
+        self.api.GetPage = lambda docID, pageCounter, type, stream=False: FakePageResponse([b'half'], fail=True)
+
+        with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+            self.api.SavePage('doc', 1, 'image', os.path.join(self.folder, 'page.tif'))
+        self.assertEqual(os.listdir(self.folder), [])
+
+    def test_missing_page_is_not_saved(self):
+        response = FakePageResponse([], status_code=404)
+        self.api.GetPage = lambda docID, pageCounter, type, stream=False: response
+
+        self.assertEqual(self.api.SavePage('doc', 1, 'image', os.path.join(self.folder, 'page.tif')), (response, None))
+        self.assertTrue(response.closed)
+
+
+
+class FakeQueryResponse:
+
+    def __init__(self, body):
+        self.status_code = 200
+        self.body = body
+
+    def iter_content(self, chunk_size=None):
+        yield self.body
+
+    def close(self):
+        pass
+
+
+class QueryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.api = AquariusWebAPIWrapper('http://aquarius', throttle=False, background_token_refresh=False)
+        self.sent = []
+
+    def fake_send(self, method, url, **kwargs):
+        self.sent.append((url, kwargs.get('params')))
+        return FakeQueryResponse(b'[]')
+
+    def test_query_is_sent_as_a_parameter(self):
+        self.api._send = self.fake_send
+        query = '{"searchValue": "A&B #1+2"}'
+
+        self.assertEqual(list(self.api.IterQuery(query)), [])
+
+        url, params = self.sent[0]
+        self.assertNotIn('?', url)
+        self.assertEqual(params, {'json': query})
+        # requests percent-encodes the parameters
+        prepared = requests.Request('GET', url, params=params).prepare()
+        self.assertIn('A%26B+%231%2B2', prepared.url)
+
+    def test_paging_parameters(self):
+        self.api._send = self.fake_send
+
+        list(self.api.IterQuery('{}', page_size=50))
+
+        self.assertEqual(self.sent[0][1], {'json': '{}', 'pageNumber': 1, 'pageSize': 50})
+
+    def test_truncated_body_raises(self):
+        self.api._send = lambda method, url, **kwargs: FakeQueryResponse(b'[{"ID": "1"}, {"ID": "2"}, {"ID"')
+        results = []
+
+        with self.assertRaises(ValueError):
+            for result in self.api.IterQuery('{}'):
+                results.append(result)
+
+        self.assertEqual(results, [{'ID': '1'}, {'ID': '2'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
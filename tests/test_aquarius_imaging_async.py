@@ -0,0 +1,74 @@
+import asyncio
+import unittest
+
+from tests import require_modules
+
+require_modules('aiohttp', 'requests', 'magic')
+
+from utils.AquariusImaging import AquariusResponse
+from utils.AquariusImagingAsync import AsyncAquariusWebAPIWrapper
+
+
+def token_response(token, refresh_token='refresh'):
+    return AquariusResponse(200, {'Content-Type': 'application/json'},
+                            ('{"access_token": "%s", "expires_in": 3600, "refresh_token": "%s"}' % (token, refresh_token)).encode())
+
+
+class AsyncTokenTests(unittest.TestCase):
+
+    def setUp(self):
+        self.api = AsyncAquariusWebAPIWrapper('http://aquarius', throttle=False)
+        self.requests = []
+        self.tokens = iter(['first', 'second', 'third'])
+        self.refresh_rejected = False
+
+    def fake_request(self, method, url, headers=None, **kwargs):
+        # answers /token with the next token, and the API with 401 unless the request has the newest token
+        async def respond():
+            self.requests.append((method, url, dict(headers or {}), kwargs.get('data')))
+            if url.endswith('/token'):
+                if kwargs['data']['grant_type'] == 'refresh_token' and self.refresh_rejected:
+                    return AquariusResponse(400, {}, b'invalid_grant')
+                return token_response(next(self.tokens))
+            if headers.get('Authorization') != 'Bearer ' + self.current:
+                return AquariusResponse(401, {}, b'')
+            return AquariusResponse(200, {}, b'{}')
+        return respond()
+
+    def run_async(self, coroutine):
+        return asyncio.run(coroutine)
+
+    def test_401_renews_the_token_and_retries(self):
+        self.api._request = self.fake_request
+
+        async def scenario():
+            await self.api.authenticate('user', 'password')
+            self.current = 'second'  # the server revokes the first token
+            return await asyncio.gather(*[self.api.GetDocument('doc') for _ in range(5)])
+
+        responses = self.run_async(scenario())
+
+        self.assertEqual([response.status_code for response in responses], [200] * 5)
+        # one refresh for all the tasks that got a 401
+        token_requests = [request for request in self.requests if request[1].endswith('/token')]
+        self.assertEqual(len(token_requests), 2)
+        self.assertEqual(token_requests[1][3]['grant_type'], 'refresh_token')
+
+    def test_rejected_refresh_token_logs_in_again(self):
+        self.api._request = self.fake_request
+        self.refresh_rejected = True
+
+        async def scenario():
+            await self.api.authenticate('user', 'password')
+            self.current = 'second'
+            return await self.api.GetDocument('doc')
+
+        response = self.run_async(scenario())
+
+        self.assertEqual(response.status_code, 200)
+        grant_types = [request[3]['grant_type'] for request in self.requests if request[1].endswith('/token')]
+        self.assertEqual(grant_types, ['password', 'refresh_token', 'password'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import asyncio
+import unittest
+
+from utils.AquariusThrottle import AdaptiveConcurrencyLimiter
+
+
+class AsyncAcquireTests(unittest.TestCase):
+
+    def test_waiters_get_slots_in_order(self):
+        async def scenario():
+            limiter = AdaptiveConcurrencyLimiter(initial_limit=1)
+            await limiter.acquire_async()
+            order = []
+
+            async def wait(index):
+                await limiter.acquire_async()
+                order.append(index)
+                await asyncio.sleep(0)
+                limiter.release()
+
+            tasks = [asyncio.create_task(wait(index)) for index in range(5)]
+            await asyncio.sleep(0)
+            tasks[2].cancel()
+            limiter.release()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            return order, limiter.in_flight
+
+        order, in_flight = asyncio.run(scenario())
+
+        self.assertEqual(order, [0, 1, 3, 4])
+        self.assertEqual(in_flight, 0)
+
+    def test_cancelled_waiter_gives_back_a_slot_handed_to_it(self):
+        async def scenario():
+            limiter = AdaptiveConcurrencyLimiter(initial_limit=1)
+            await limiter.acquire_async()
+            waiter = asyncio.create_task(limiter.acquire_async())
+            await asyncio.sleep(0)
+            limiter.release()
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+            await asyncio.sleep(0)
+            return limiter.in_flight
+
+        self.assertEqual(asyncio.run(scenario()), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from service.file_manifest import FileManifest
+
+
+class FileManifestTests(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.folder, 'page.txt')
+        self.write(b'some text')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def write(self, content, mtime=None):
+        with open(self.file_path, 'wb') as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(self.file_path, (mtime, mtime))
+
+    def manifest(self, **settings):
+        manifest = FileManifest(os.path.join(self.folder, 'manifest.db'), **settings)
+        self.addCleanup(manifest.close)
+        return manifest
+
+    def test_changed_file_is_processed_again(self):
+        manifest = self.manifest()
+        self.assertFalse(manifest.is_processed('ocr', self.file_path))
+
+        manifest.record('ocr', self.file_path)
+        self.assertTrue(manifest.is_processed('ocr', self.file_path))
+        self.assertFalse(manifest.is_processed('import', self.file_path))
+
+        self.write(b'other text', mtime=1000000)
+        self.assertFalse(manifest.is_processed('ocr', self.file_path))
+
+    def test_copied_file_counts_as_processed_with_use_hash(self):
+        manifest = self.manifest(use_hash=True)
+        manifest.record('ocr', self.file_path)
+
+        # same content, new time
+        self.write(b'some text', mtime=1000000)
+        self.assertTrue(manifest.is_processed('ocr', self.file_path))
+
+        self.write(b'more text', mtime=2000000)
+        self.assertFalse(manifest.is_processed('ocr', self.file_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from tests import require_modules
+
+require_modules('watchdog', 'dotenv')
+
+from service.generic_handler import FileHandler
+from service.generic_watcher import GenericWatcher
+from service.file_manifest import FileManifest
+from service.job_store import JobStore, DONE
+from service.work_queue import WorkQueue
+
+
+class RecordingProcessor:
+    # processes every file by remembering it
+
+    def __init__(self, folder, process_existing_files=True):
+        self.config = {'folder_to_watch': folder, 'process_existing_files': process_existing_files, 'stable_time': 0.2}
+        self.processed = []
+        self.lock = threading.Lock()
+
+    def Process(self, file_path):
+        with self.lock:
+            self.processed.append(file_path)
+        return True
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+class FileHandlerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.data = tempfile.mkdtemp()
+        self.folder = os.path.join(self.data, 'watched')
+        os.mkdir(self.folder)
+        self.addCleanup(shutil.rmtree, self.data, ignore_errors=True)
+
+    def add_file(self, name):
+        file_path = os.path.join(self.folder, name)
+        with open(file_path, 'w') as f:
+            f.write(name)
+        return file_path
+
+    def test_handler_with_job_store(self):
+        file_path = self.add_file('a.txt')
+        processor = RecordingProcessor(self.folder)
+        store = JobStore(os.path.join(self.data, 'jobs.db'))
+        manifest = FileManifest(os.path.join(self.data, 'manifest.db'))
+        self.addCleanup(manifest.close)
+
+        handler = FileHandler(processor, manifest, store)
+        handler.ProcessALL()
+        self.assertTrue(wait_for(lambda: store.count(handler.manifest_key, DONE) == 1))
+        handler.stop()
+
+        self.assertEqual(processor.processed, [file_path])
+        self.assertTrue(manifest.is_processed(handler.manifest_key, file_path))
+
+    def test_only_files_with_the_processor_extensions_are_queued(self):
+        text_file = self.add_file('a.txt')
+        self.add_file('a.txt.k2j4.tmp')
+        processor = RecordingProcessor(self.folder)
+        processor.extensions = ('.txt',)
+        store = JobStore(os.path.join(self.data, 'jobs.db'))
+
+        handler = FileHandler(processor, None, store)
+        handler.ProcessALL()
+        self.assertTrue(wait_for(lambda: store.count(handler.manifest_key, DONE) == 1))
+        handler.stop()
+
+        self.assertEqual(processor.processed, [text_file])
+
+    def test_files_still_being_written_are_queued_for_the_next_start(self):
+        processor = RecordingProcessor(self.folder)
+        processor.config['stable_time'] = 60
+        store = JobStore(os.path.join(self.data, 'jobs.db'))
+
+        handler = FileHandler(processor, None, store)
+        handler.tracker.track(self.add_file('a.txt'))
+        handler.stop()
+
+        self.assertEqual(processor.processed, [])
+        self.assertEqual(store.count(handler.manifest_key), 1)
+
+    def test_file_put_while_processing_is_processed_again(self):
+        started = threading.Event()
+        release = threading.Event()
+        processed = []
+
+        def process(file_path):
+            processed.append(file_path)
+            started.set()
+            release.wait(10)
+
+        work_queue = WorkQueue(process, workers=2)
+        work_queue.put('a.txt')
+        started.wait(10)
+        self.assertTrue(work_queue.put('a.txt'))
+        self.assertFalse(work_queue.put('a.txt'))
+        # not by the other worker at the same time
+        time.sleep(0.2)
+        self.assertEqual(processed, ['a.txt'])
+        release.set()
+        work_queue.stop()
+
+        self.assertEqual(processed, ['a.txt', 'a.txt'])
+
+    def test_job_queued_while_running_is_queued_again_when_done(self):
+        store = JobStore(os.path.join(self.data, 'jobs.db'))
+        store.enqueue('q', 'a.txt')
+        job = store.claim('q', 'worker')
+
+        self.assertTrue(store.enqueue('q', 'a.txt'))
+        store.complete(job)
+
+        self.assertEqual(store.count('q'), 1)
+        self.assertEqual(store.count('q', DONE), 0)
+
+    def test_purge_deletes_old_done_jobs(self):
+        store = JobStore(os.path.join(self.data, 'jobs.db'))
+        for path in ('a.txt', 'b.txt'):
+            store.enqueue('q', path)
+            store.complete(store.claim('q', 'worker'))
+        store.enqueue('q', 'c.txt')
+
+        self.assertEqual(store.purge(3600), 0)
+        self.assertEqual(store.purge(0), 2)
+        self.assertEqual(store.count('q'), 1)
+
+    def test_watcher_processes_existing_and_new_files(self):
+        existing = self.add_file('existing.txt')
+        processor = RecordingProcessor(self.folder)
+        watcher = GenericWatcher([processor], manifest_path=os.path.join(self.data, 'manifest.db'),
+                                 job_store_path=os.path.join(self.data, 'jobs.db'))
+        watcher.start()
+        try:
+            new = self.add_file('new.txt')
+            self.assertTrue(wait_for(lambda: len(processor.processed) >= 2))
+        finally:
+            watcher.stop()
+            watcher.manifest.close()
+
+        self.assertEqual(sorted(processor.processed), sorted([existing, new]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import threading
+import unittest
+
+from tests import require_modules
+
+require_modules('pysolr')
+
+import pysolr
+
+from service.solr_indexer import SolrIndexer, is_retryable
+
+
+class FakeSolr:
+    # rejects batches holding a document marked bad, and fails to connect while down is set
+
+    def __init__(self):
+        self.down = False
+        self.received = []
+        self.lock = threading.Lock()
+
+    def add(self, documents, commit=False, commitWithin=None):
+        if self.down:
+            raise pysolr.SolrError("Failed to connect to server at http://solr: Connection refused")
+        if any(document.get('bad') for document in documents):
+            raise pysolr.SolrError('Solr responded with an error (HTTP 400): unknown field')
+        with self.lock:
+            self.received.extend(document['id'] for document in documents)
+
+
+class SolrIndexerTests(unittest.TestCase):
+
+    def indexer(self, **settings):
+        indexer = SolrIndexer('http://solr/core', flush_interval=0.05, **settings)
+        indexer.solr = FakeSolr()
+        return indexer
+
+    def test_retryable_errors(self):
+        self.assertTrue(is_retryable(pysolr.SolrError("Connection to server 'http://solr' timed out: read timeout")))
+        self.assertTrue(is_retryable(pysolr.SolrError('Solr responded with an error (HTTP 503): busy')))
+        self.assertTrue(is_retryable(pysolr.SolrError('Solr responded with an error (HTTP 429): slow down')))
+        self.assertFalse(is_retryable(pysolr.SolrError('Solr responded with an error (HTTP 400): unknown field')))
+        self.assertFalse(is_retryable(ValueError('not json')))
+
+    def test_rejected_document_is_dropped_and_the_rest_are_sent(self):
+        indexer = self.indexer(batch_size=8, max_pending=8)
+        for i in range(20):
+            indexer.add({'id': str(i), 'bad': i == 5})
+        indexer.stop()
+
+        self.assertEqual(sorted(indexer.solr.received, key=int), [str(i) for i in range(20) if i != 5])
+
+
+    def test_future_is_done_once_solr_has_the_document(self):
+        indexer = self.indexer()
+        good = indexer.add({'id': 'good'})
+        bad = indexer.add({'id': 'bad', 'bad': True})
+
+        self.assertTrue(good.result(timeout=5))
+        self.assertIsInstance(bad.exception(timeout=5), pysolr.SolrError)
+        indexer.stop()
+
+    def test_documents_not_sent_before_stop_fail(self):
+        indexer = self.indexer()
+        indexer.solr.down = True
+        future = indexer.add({'id': '1'})
+        indexer.stop()
+
+        self.assertIsNotNone(future.exception(timeout=5))
+        self.assertEqual(indexer.solr.received, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from tests import require_modules
+
+require_modules('watchdog', 'dotenv')
+
+from service.service_runners import RUNNERS, WatcherRunner
+from service.supervisor import Supervisor
+
+# the folder of the running test, inherited by the forked workers
+unit_folder = None
+
+
+class CrashOnceRunner(WatcherRunner):
+    # exits the first time a worker starts it, then runs until it is stopped
+
+    @classmethod
+    def all_units(cls):
+        return [unit_folder]
+
+    def create_processors(self):
+        return []
+
+    def start(self):
+        self.stopped = threading.Event()
+        if not os.path.exists(self.marker('started')):
+            open(self.marker('started'), 'w').close()
+            os._exit(3)
+        open(self.marker('running'), 'w').close()
+
+    def run(self):
+        self.stopped.wait()
+
+    def stop(self):
+        self.stopped.set()
+        open(self.marker('stopped'), 'w').close()
+
+    def marker(self, name):
+        return os.path.join(self.units[0], name)
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+class SupervisorTests(unittest.TestCase):
+
+    def setUp(self):
+        global unit_folder
+        unit_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, unit_folder, ignore_errors=True)
+        RUNNERS['crash-once'] = CrashOnceRunner
+        self.addCleanup(RUNNERS.pop, 'crash-once')
+
+    @unittest.skipUnless(multiprocessing.get_start_method() == 'fork', 'the workers have to inherit the test runner')
+    def test_crashed_worker_is_restarted_and_stopped(self):
+        supervisor = Supervisor('crash-once', processes=1, restart_delay=0.1, stop_timeout=10)
+        supervisor.start()
+        thread = threading.Thread(target=supervisor.run, kwargs={'check_interval': 0.1})
+        thread.start()
+        try:
+            self.assertTrue(wait_for(lambda: os.path.exists(os.path.join(unit_folder, 'running'))))
+        finally:
+            supervisor.stop()
+            thread.join(10)
+
+        worker = supervisor.workers[0]
+        self.assertEqual(worker.restart_delay, 0.1)
+        self.assertEqual(worker.process.exitcode, 0)
+        self.assertTrue(os.path.exists(os.path.join(unit_folder, 'stopped')))
+        self.assertFalse(thread.is_alive())
+
+    def test_supervisor_refuses_an_incomplete_runner(self):
+        class NoUnits(WatcherRunner):
+            def create_processors(self):
+                return []
+
+        RUNNERS['incomplete'] = NoUnits
+        self.addCleanup(RUNNERS.pop, 'incomplete')
+
+        with self.assertRaisesRegex(Exception, 'all_units'):
+            Supervisor('incomplete')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+########################################################################################################################
+#
+# Purpose: This script contains caches used to avoid repeating Web API calls: a general purpose thread safe LRU cache
+# with expiry, and a cache for query definitions that can also be kept on disk between runs.
+#
+########################################################################################################################
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+
+class TTLCache:
+    """
+    A thread safe dictionary that holds at most max_size entries (the least recently used go first) and forgets
+    entries ttl seconds after they were set. A ttl or max_size of None means no limit.
+    """
+
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            value, expires = entry
+            if expires is not None and time.monotonic() >= expires:
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl if self.ttl is not None else None)
+            self._entries.move_to_end(key)
+            if self.max_size is not None:
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class QueryDefinitionCache:
+    """
+    Caches query definitions by server and doctype for ttl seconds. With a directory, definitions are also saved
+    there as json files, so they survive restarts and are shared by every script and service on the machine.
+    The cache keeps the raw json body; every caller parses its own copy, so nobody can change what others get.
+    """
+
+    def __init__(self, ttl=3600, directory=None):
+        self.ttl = ttl
+        self.directory = directory
+        self._memory = TTLCache(ttl=ttl)
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, server, doctypeID):
+        """
+        Returns the cached json body of the query definition, or None.
+        """
+        key = (server.rstrip('/').lower(), doctypeID)
+        content = self._memory.get(key)
+        if content is None and self.directory:
+            content = self._read(key)
+            if content is not None:
+                self._memory.set(key, content)
+        return content
+
+    def set(self, server, doctypeID, content):
+        key = (server.rstrip('/').lower(), doctypeID)
+        self._memory.set(key, content)
+        if self.directory:
+            self._write(key, content)
+
+    def invalidate(self, server, doctypeID):
+        key = (server.rstrip('/').lower(), doctypeID)
+        self._memory.invalidate(key)
+        if self.directory:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1('|'.join(key).encode('UTF-8')).hexdigest() + '.json')
+
+    def _read(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='UTF-8') as f:
+                entry = json.load(f)
+            saved = float(entry['saved'])
+            content = entry['queryDef'].encode('UTF-8')
+        except OSError:
+            return None
+        except (ValueError, KeyError, TypeError, AttributeError) as ex:
+            # not a cache entry (truncated, or written by something else): remove it and treat it as a miss
+            print(f'{datetime.now()} Removing bad query definition cache file {path}: {str(ex)}')
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+        if self.ttl is not None and time.time() - saved >= self.ttl:
+            return None
+        return content
+
+    def _write(self, key, content):
+        entry = {'server': key[0], 'doctypeID': key[1], 'saved': time.time(), 'queryDef': content.decode('UTF-8')}
+        try:
+            # write to a temporary file and rename it, so other processes never read half a file.
+            with tempfile.NamedTemporaryFile('w', encoding='UTF-8', dir=self.directory, suffix='.tmp', delete=False) as f:
+                json.dump(entry, f)
+            os.replace(f.name, self._path(key))
+        except OSError as ex:
+            print(f'{datetime.now()} Error saving query definition cache: {str(ex)}')
+
+
+_shared_query_definition_cache = None
+_shared_lock = threading.Lock()
+
+
+def get_shared_query_definition_cache():
+    """
+    Returns the query definition cache shared by every wrapper in the process that isn't given its own.
+    Set QUERYDEF_CACHE_DIR (for example in the .env file) to also keep the definitions on disk. It is created on
+    first use rather than on import, so scripts can load their .env file first.
+    """
+    global _shared_query_definition_cache
+    with _shared_lock:
+        if _shared_query_definition_cache is None:
+            _shared_query_definition_cache = QueryDefinitionCache(directory=os.environ.get('QUERYDEF_CACHE_DIR') or None)
+        return _shared_query_definition_cache
@@ -14,6 +14,8 @@ import tifftools
 from datetime import datetime
 import pandas as pd
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 class CrossRefDataWriter:
@@ -32,6 +34,7 @@ class CrossRefDataWriter:
     
         #create image cross reference data file.
         self.imageXRefFile = open(self.imageXRefFilePath,'ab')
+        self._lock = threading.Lock()
     
         # write the column headers only if the file is empty
         if os.path.getsize(self.imageXRefFilePath) == 0:
@@ -52,15 +55,73 @@ class CrossRefDataWriter:
     @property
     def last_page(self):
         return self._last_page
+
+    def DocumentIDs(self):
+        # the doc_ids that already have rows in the cross reference file
+        with self._lock, open(self.imageXRefFilePath, 'r', encoding='UTF-8') as f:
+            next(f, None)  # column headers
+            return {line.split('\t')[0] for line in f if line.endswith('\n')}
     
     def Write(self,docID,pageCounter,fileName):
-        self.imageXRefFile.write(bytes(docID + '\t' + str(pageCounter) + '\t' + fileName + '\n','UTF-8'))
-        self.imageXRefFile.flush()
+        self.WriteDocument(docID, [(pageCounter, fileName)])
+
+    def WriteDocument(self, docID, pages):
+        # writes all the (pageCounter, fileName) rows of a document in one go, so rows from documents
+        # downloaded at the same time never interleave.
+        rows = ''.join(docID + '\t' + str(pageCounter) + '\t' + fileName + '\n' for pageCounter, fileName in pages)
+        with self._lock:
+            self.imageXRefFile.write(bytes(rows,'UTF-8'))
+            self.imageXRefFile.flush()
 
     def Close(self):
         self.imageXRefFile.close()
 
 
+class DownloadJournal:
+    """
+    Records every document that has been downloaded completely, one doc_id per line, next to the input file.
+    Unlike the last line of the ImageXRef file, this doesn't depend on the order documents finish in, so it is
+    used to resume downloads that run several documents at once.
+    A new journal starts with completed_doc_ids, the documents an earlier run without a journal already downloaded.
+    """
+    def __init__(self, inputfile, completed_doc_ids=()):
+        self.journalFilePath = os.path.splitext(inputfile)[0] + 'Journal.txt'
+        self._lock = threading.Lock()
+        self._completed = set()
+
+        exists = os.path.exists(self.journalFilePath)
+        if exists:
+            with open(self.journalFilePath, 'r', encoding='UTF-8') as f:
+                # a line without a newline was cut off by a crash, so it doesn't count.
+                self._completed = {line[:-1] for line in f if line.endswith('\n')}
+
+        self.journalFile = open(self.journalFilePath, 'a', encoding='UTF-8')
+
+        if not exists and completed_doc_ids:
+            with self._lock:
+                self.journalFile.writelines(docID + '\n' for docID in completed_doc_ids)
+                self.journalFile.flush()
+                os.fsync(self.journalFile.fileno())
+                self._completed.update(completed_doc_ids)
+
+    @staticmethod
+    def Exists(inputfile):
+        return os.path.exists(os.path.splitext(inputfile)[0] + 'Journal.txt')
+
+    def IsComplete(self, docID):
+        return docID in self._completed
+
+    def Complete(self, docID):
+        with self._lock:
+            self.journalFile.write(docID + '\n')
+            self.journalFile.flush()
+            os.fsync(self.journalFile.fileno())
+            self._completed.add(docID)
+
+    def Close(self):
+        self.journalFile.close()
+
+
 def GetMergedData(inputFile):
         
     #read csv for document indexes
@@ -93,8 +154,11 @@ class TimeEstimator:
     
    
 class QueryResultsDownloader:
-    def __init__(self, server, username, password):
-        self.webApi = AquariusImaging.AquariusWebAPIWrapper(server)
+    def __init__(self, server, username, password, pool_maxsize=16, chunk_size=AquariusImaging.DOWNLOAD_CHUNK_SIZE):
+        # pool_maxsize should be at least page_workers + document_workers (see download_documents)
+        self.webApi = AquariusImaging.AquariusWebAPIWrapper(server, pool_maxsize=pool_maxsize)
+        # pages are streamed to disk chunk_size bytes at a time
+        self.chunk_size = chunk_size
         if (username != ""):
             self.webApi.authenticate(username, password)
         
@@ -104,12 +168,29 @@ class QueryResultsDownloader:
             password = input("password: ")
             self.webApi.authenticate(username, password)
 
-    def download_documents(self, inputFile, multiPage, uniqueIdentifier, type='image'):
+    def download_documents(self, inputFile, multiPage, uniqueIdentifier, type='image', page_workers=1, document_workers=1):
+        """
+        Downloads the documents listed in inputFile. page_workers is the number of pages that are downloaded
+        at the same time (shared by all the documents in flight), document_workers the number of documents.
+
+        With more than one document worker, finished documents are recorded in a DownloadJournal and a restart
+        skips all of them, whatever order they finished in. Documents that were only partly downloaded are
+        downloaded again from the first page. Once a journal exists for inputFile it is always used to resume.
+        A journal created for an input that was started without one begins with the documents already in the
+        ImageXRef file, so switching to several document workers doesn't download them again.
+        """
         with open(inputFile, 'r', encoding='UTF-8') as queryResultsData:
             
             XrefDataWriter = CrossRefDataWriter(inputFile, uniqueIdentifier)
+
+            journal = None
+            journal_exists = DownloadJournal.Exists(inputFile)
+            if document_workers > 1 or journal_exists:
+                # a run started without a journal may already have documents in the ImageXRef file
+                journal = DownloadJournal(inputFile, () if journal_exists else XrefDataWriter.DocumentIDs())
+
               # initialize the variable that determines if we are caught up to the last doc_id
-            self.caughtUp = (XrefDataWriter.last_doc_id == '')
+            self.caughtUp = (XrefDataWriter.last_doc_id == '') or journal is not None
 
             # Count the total number of lines in the file, subtracting the header line
             self.totalDocuments = sum(1 for line in queryResultsData) - 1
@@ -120,10 +201,59 @@ class QueryResultsDownloader:
             self.time_estimator = None
 
             self.docCounter = 0
+            self._progress_lock = threading.Lock()
 
             self.time_estimator = TimeEstimator(self.totalDocuments - self.docCounter)
 
-            self.process_documents(queryResultsData, XrefDataWriter, multiPage, type)
+            # pages are fetched by a pool of workers that lives for the whole run.
+            try:
+                with ThreadPoolExecutor(max_workers=max(page_workers, 1), thread_name_prefix='page') as self.page_executor:
+                    if journal is None:
+                        self.process_documents(queryResultsData, XrefDataWriter, multiPage, type)
+                    else:
+                        self.process_documents_parallel(queryResultsData, XrefDataWriter, multiPage, type, journal, document_workers)
+            finally:
+                if journal is not None:
+                    journal.Close()
+
+    def process_documents_parallel(self, queryResultsData, XrefDataWriter, multiPage, type, journal, document_workers):
+        # only keep a couple of documents per worker queued up, so huge input files aren't read into memory.
+        slots = threading.BoundedSemaphore(document_workers * 2)
+        errors = []
+
+        def download(docID):
+            try:
+                if not errors:
+                    self.process_document(docID, XrefDataWriter, multiPage, type)
+                    journal.Complete(docID)
+            except Exception as ex:
+                errors.append(ex)
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=document_workers, thread_name_prefix='document') as document_executor:
+            for resultLine in queryResultsData:
+                docID = resultLine.split('\t')[0]
+                if docID == 'doc_id':
+                    continue
+
+                # stop handing out documents after the first failure, like the sequential download does.
+                if errors:
+                    break
+
+                if journal.IsComplete(docID):
+                    with self._progress_lock:
+                        self.docCounter += 1
+                    print(f'{datetime.now()} Skipping {docID}, already Downloaded ')
+                    continue
+
+                slots.acquire()
+                document_executor.submit(download, docID)
+
+        if errors:
+            raise errors[0]
+
+        print(f'{datetime.now()} Process complete! {self.docCounter} documents downloaded.')
 
     def process_documents(self, queryResultsData, XrefDataWriter, multiPage, type):
         for resultLine in queryResultsData:
@@ -136,7 +266,9 @@ class QueryResultsDownloader:
         print(f'{datetime.now()} Process complete! {self.docCounter} documents downloaded.')
 
     def process_document(self, docID, XrefDataWriter, multiPage, type):
-        self.docCounter += 1
+        with self._progress_lock:
+            self.docCounter += 1
+            docCounter = self.docCounter
         starting_page = 1
         if not self.caughtUp:
             if docID == XrefDataWriter.last_doc_id:
@@ -150,8 +282,9 @@ class QueryResultsDownloader:
                 #exit the function
                 return
             
-        self.time_estimator.increment_documents_downloaded()  
-        print(f'{datetime.now()} Downloading {docID} {self.docCounter}/{self.totalDocuments} {self.docCounter/self.totalDocuments*100:.0f}% ({self.time_estimator.get_estimated_remaining_time()/60:.0f} minutes remaining)')
+        with self._progress_lock:
+            self.time_estimator.increment_documents_downloaded()  
+        print(f'{datetime.now()} Downloading {docID} {docCounter}/{self.totalDocuments} {docCounter/self.totalDocuments*100:.0f}% ({self.time_estimator.get_estimated_remaining_time()/60:.0f} minutes remaining)')
         docresponse = self.webApi.GetDocument(docID)
         if docresponse.status_code == 200:
             doc = docresponse.json()
@@ -161,50 +294,47 @@ class QueryResultsDownloader:
 
     def process_pages(self, doc, docID, XrefDataWriter, multiPage, type, starting_page):
 
-        # initialize a page files list to store the saved files for this document.
-        self.page_files = []
+        # download the pages in parallel. map hands the results back in page order, however the downloads finish,
+        # so the cross reference file and the multi page tiff still get the pages in the right order.
+        pages = range(starting_page, doc["pageCount"] + 1)
+        page_files = self.page_executor.map(lambda pageCounter: self.process_page(docID, pageCounter, XrefDataWriter, type), pages)
 
-        for pageCounter in range(starting_page, doc["pageCount"] + 1):
-            self.process_page(docID, pageCounter, XrefDataWriter,  type)
+        # drop the pages that could not be downloaded.
+        page_files = [page_file for page_file in page_files if page_file is not None]
         
         if multiPage:
-            if(len(self.page_files) == 1):
+            if(len(page_files) == 1):
                 pageCounter = 1
-                XrefDataWriter.Write(docID,pageCounter,self.page_files[0])   
-            else:
-                self.create_multi_page_tiff(docID, XrefDataWriter)
+                XrefDataWriter.Write(docID,pageCounter,page_files[0])   
+            elif page_files:
+                XrefDataWriter.Write(docID, 1, self.create_multi_page_tiff(page_files))
         else:
-            #loop through the page files and write them to the cross reference file.
-            for pageCounter, page_file in enumerate(self.page_files, start=1):
-                XrefDataWriter.Write(docID, pageCounter, page_file)
+            #write the page files to the cross reference file.
+            XrefDataWriter.WriteDocument(docID, enumerate(page_files, start=1))
 
-    def create_multi_page_tiff(self, docID, XrefDataWriter):
+    def create_multi_page_tiff(self, page_files):
         newTif = None
-        for tiffFile in self.page_files:
+        for tiffFile in page_files:
             if newTif is None:
                 newTif = tifftools.read_tiff(tiffFile)
             else:
                 tiftoadd = tifftools.read_tiff(tiffFile)
                 newTif['ifds'].extend(tiftoadd['ifds'])
-        multiTiff = self.page_files[0].lower().replace(".tif", "-multi.tif")
+        multiTiff = page_files[0].lower().replace(".tif", "-multi.tif")
         tifftools.write_tiff(newTif, multiTiff)
-        XrefDataWriter.Write(docID, 1, multiTiff)
-        for imagefile in self.page_files:
+        for imagefile in page_files:
             os.remove(imagefile)    
+        return multiTiff
 
     def process_page(self, docID, pageCounter, XrefDataWriter,  type):
-        response = self.webApi.GetPage(docID, pageCounter, type)
-        if response.status_code == 200:
-            self.save_page(response, docID, pageCounter, XrefDataWriter)
-            
-        elif response.status_code == 401:
+        # returns the saved file name, or None if the page could not be downloaded.
+        # a page whose download breaks off is requested again (see AquariusWebAPIWrapper.SavePage)
+        response, fileName = self.webApi.SavePage(docID, pageCounter, type,
+                                                  lambda response: self.get_filename(response, docID, pageCounter, XrefDataWriter),
+                                                  self.chunk_size)
+        if response.status_code == 401:
             raise Exception(f'Unauthorized to download document {docID}.')
-
-    def save_page(self, response, docID, pageCounter, XrefDataWriter):
-        fileName = self.get_filename(response, docID, pageCounter, XrefDataWriter)
-        with open(fileName, 'wb+') as imageFile:
-            imageFile.write(response.content)
-            self.page_files.append(fileName)
+        return fileName
 
     def get_filename(self, response, docID, pageCounter, XrefDataWriter):
         fileName = response.headers['Content-Disposition']
@@ -1,14 +1,27 @@
 import utils.AquariusImaging as AquariusImaging
-import tempfile
+from utils.AquariusCache import TTLCache
+from utils.TIFFSplitter import TIFFSplitter
+from utils.FileStabilityTracker import FileStabilityTracker
+import json
 from watchdog.events import FileSystemEventHandler
 from datetime import datetime
 import os
-import time
-import cv2
 
 class AquariusFileHandler(FileSystemEventHandler):
    
-    def __init__(self, doctypeCode,fieldMap,server,username,password, appendExistingDocuments,filter, data_extractor_function, extensions_to_watch = ['.tif', '.jpg', '.jpeg','.pdf', '.png']):
+    def __init__(self, doctypeCode,fieldMap,server,username,password, appendExistingDocuments,filter, data_extractor_function, extensions_to_watch = ['.tif', '.jpg', '.jpeg','.pdf', '.png'],
+                 lookup_cache_size=10000, lookup_cache_ttl=3600, invalidate_lookup_on_error=True, prewarm_lookup_cache=False,
+                 page_spill_size=AquariusImaging.PAGE_SPILL_SIZE, stable_time=2):
+        """
+        When appendExistingDocuments is on, the docID found (or created) for each set of index values is remembered
+        for lookup_cache_ttl seconds, up to lookup_cache_size entries, so a burst of files for the same document
+        only runs the query once. A lookup_cache_size of 0 turns this off. With invalidate_lookup_on_error, an upload
+        that fails forgets the docID so the next file looks it up again. prewarm_lookup_cache fills the cache from
+        one broad query at startup (see PrewarmLookupCache).
+        The pages of a multipage TIFF are split into memory and uploaded from there; pages larger than
+        page_spill_size bytes go to a temporary file instead.
+        New files are processed once their size hasn't changed for stable_time seconds.
+        """
         super().__init__()
 
         self.appendExistingDocuments = appendExistingDocuments
@@ -17,6 +30,14 @@ class AquariusFileHandler(FileSystemEventHandler):
         self.appendExistingDocuments = appendExistingDocuments
         self.extensions_to_watch = extensions_to_watch  # ['.tif', '.jpg', '.jpeg','.pdf', '.png']  # Example extensions
 
+        # index values -> docID
+        self.lookup_cache = TTLCache(max_size=lookup_cache_size, ttl=lookup_cache_ttl) if lookup_cache_size else None
+        self.invalidate_lookup_on_error = invalidate_lookup_on_error
+        self.page_spill_size = page_spill_size
+
+        # new files are processed once they are completely written, see utils.FileStabilityTracker
+        self.tracker = FileStabilityTracker(self.ProcessFile, stable_time=stable_time)
+
         # Authenticate to Aquarius Imaging
         self.aqApi =  AquariusImaging.AquariusWebAPIWrapper(server)                     
         self.aqApi.authenticate(username,password)
@@ -35,7 +56,55 @@ class AquariusFileHandler(FileSystemEventHandler):
         else:
            
             raise Exception(f'{datetime.now()} Error authenticating to Aquarius Imaging')
+
+        if prewarm_lookup_cache and self.appendExistingDocuments:
+            self.PrewarmLookupCache()
               
+    def _lookup_key(self, indexValues):
+        # the index values the lookup query searches on, in field map order
+        return tuple(indexValues[value['index']] for field, value in self.JSONHelper.fieldMap.items() if field != "")
+
+    def InvalidateLookup(self, indexValues=None):
+        """
+        Forgets the cached docID for a set of index values, or every cached docID if indexValues is None.
+        """
+        if self.lookup_cache is not None:
+            if indexValues is None:
+                self.lookup_cache.clear()
+            else:
+                self.lookup_cache.invalidate(self._lookup_key(indexValues))
+
+    def _upload_failed(self, lookupKey):
+        # the document may have been deleted or be otherwise unusable, so look it up again next time.
+        if self.invalidate_lookup_on_error and lookupKey is not None:
+            self.lookup_cache.invalidate(lookupKey)
+
+    def PrewarmLookupCache(self, query=None):
+        """
+        Runs one broad query (by default the query definition with no search values) and caches the docID of every
+        hit under its index values. This only saves lookups if the server returns the index values formatted the
+        same way the data extractor produces them.
+        """
+        if self.lookup_cache is None:
+            return
+
+        fieldNames = self.JSONHelper._queryfieldDictionary()
+        count = 0
+        for document in self.aqApi.IterQuery(query or json.dumps(self.JSONHelper.queryDef)):
+            values = {entry.get('fieldName'): entry.get('value') for entry in document.get('indexData', [])}
+            key = []
+            for field in self.JSONHelper.fieldMap:
+                if field == "":
+                    continue
+                key.append(values.get(fieldNames.get(field), values.get(field)))
+            if None not in key:
+                # keep the first document found, like a lookup query does
+                if self.lookup_cache.get(tuple(key)) is None:
+                    self.lookup_cache.set(tuple(key), document['docID'])
+                    count += 1
+
+        print(f'{datetime.now()} Lookup cache prewarmed with {count} documents')
+
 
 
     def checkFilter(self, indexValues):
@@ -62,18 +131,24 @@ class AquariusFileHandler(FileSystemEventHandler):
 
 
     def on_created(self, event):
-        try:
-            if not event.is_directory:
-                file_extension = os.path.splitext(event.src_path.lower())[1]
-                if file_extension in self.extensions_to_watch:
-                    file_path = event.src_path
-                    file_size = -1
-                    while os.path.getsize(file_path) != file_size:
-                        file_size = os.path.getsize(file_path)
-                        time.sleep(5) # wait for 5 seconds
-                    self.ProcessFile(file_path)
-        except Exception as ex:
-            print(f'{datetime.now()} Error: {str(ex)}')
+        # the file is processed once it is fully written
+        if not event.is_directory:
+            file_extension = os.path.splitext(event.src_path.lower())[1]
+            if file_extension in self.extensions_to_watch:
+                self.tracker.track(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.tracker.modified(event.src_path)
+
+    def on_closed(self, event):
+        # only reported on platforms that can (inotify on Linux)
+        if not event.is_directory:
+            self.tracker.closed(event.src_path)
+
+    def stop(self):
+        # stop checking new files, and finish the ones already being processed
+        self.tracker.stop()
 
     def ProcessFile(self, file_path):
 
@@ -93,19 +168,29 @@ class AquariusFileHandler(FileSystemEventHandler):
 
                         docID = None
                         queryResults = []
+                        lookupKey = None
 
                         #if we're appending documents, attempt to look up this document.
                         if (self.appendExistingDocuments == True):
-                        
-                            #run the query
-                            response = self.aqApi.RunQuery(self.JSONHelper.query_JSON(indexValues))
-                            if (response.status_code==200):
-                                queryResults = response.json()
 
-                            if(len(queryResults) > 0):
-                                #if document was found, use the docid of the first one
-                                docID = queryResults[0]["docID"]
-                                print(f'{datetime.now()} Document Found: {docID}') 
+                            #check the documents we've already looked up or created
+                            if self.lookup_cache is not None:
+                                lookupKey = self._lookup_key(indexValues)
+                                docID = self.lookup_cache.get(lookupKey)
+
+                            if docID is not None:
+                                queryResults = [{"docID": docID}]
+                                print(f'{datetime.now()} Document Found (cached): {docID}') 
+                            else:
+                                #run the query
+                                response = self.aqApi.RunQuery(self.JSONHelper.query_JSON(indexValues))
+                                if (response.status_code==200):
+                                    queryResults = response.json()
+
+                                if(len(queryResults) > 0):
+                                    #if document was found, use the docid of the first one
+                                    docID = queryResults[0]["docID"]
+                                    print(f'{datetime.now()} Document Found: {docID}') 
 
                         #if a document was NOT found, create one
                         if (docID == None):
@@ -116,45 +201,33 @@ class AquariusFileHandler(FileSystemEventHandler):
                             
                             print(f'{datetime.now()} Created new document: {docID}') 
 
+                        #remember the document, so the next file with these index values is appended to it
+                        if lookupKey is not None and docID is not None:
+                            self.lookup_cache.set(lookupKey, docID)
+
                         # if this is a tif file, we need to split it into single page tiffs
                         # and upload each page individually.
                         if (file_path.lower().endswith('.tif')):                    
-                            temp_files = []
-                            # Create a temporary directory to store the single-page TIFF files.
-                            # When we exit this scope, the files are automatically deleted.
-                            with tempfile.TemporaryDirectory() as temp_dir:
-                            
-                                # Open the multipage TIFF file
-                                tiff_file = []
-
-                                #tiff_file = cv2.imread(file_path, cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR)
-                                retbool, tiff_file = cv2.imreadmulti(mats=tiff_file,
-                                                            filename=file_path,
-                                                            flags=cv2.IMREAD_ANYCOLOR)
-                                
-                                # Iterate over each page in the TIFF file
-                                if len(tiff_file) > 0:
-                                    for i in range(len(tiff_file)):
-                                        
-                                        #skip the QR Code page if we're adding to an existing document.
-                                        if not(len(queryResults) > 0 and i==0):
-                                                                                    
-                                            # Create a filename for the single-page TIFF file
-                                            output_file = os.path.join(temp_dir, f"page_{i}.tif")
-
-                                            # Save the current page to the output file
-                                            cv2.imwrite(output_file, tiff_file[i])
-                                            #file_size = os.path.getsize( tiff_file[i].filename)
-                                            print(f'{datetime.now()} Adding {output_file} to {docID}')
-                                            
-                                            temp_files.append(output_file)
-
-                                    if (self.aqApi.AddPagesToDocument(docID, temp_files).status_code != 200):
+                            #skip the QR Code page if we're adding to an existing document.
+                            first_page = 1 if len(queryResults) > 0 else 0
+
+                            # The pages are copied without being decoded, into memory buffers
+                            # that are released when we exit this scope.
+                            with TIFFSplitter(file_path, first_page, self.page_spill_size) as splitter:
+                                pages = splitter.get_pages()
+
+                                for page in pages:
+                                    print(f'{datetime.now()} Adding {page.name} to {docID}')
+
+                                if pages:
+                                    if (self.aqApi.AddPagesToDocument(docID, pages).status_code != 200):
+                                        self._upload_failed(lookupKey)
                                         raise Exception(f'Error uploading files:')
                         else:
                             #if this is not a tif file, just upload it.
                             print(f'{datetime.now()} Adding {file_path} to {docID}')
                             if (self.aqApi.AddPagesToDocument(docID, [file_path]).status_code != 200):
+                                self._upload_failed(lookupKey)
                                 raise Exception(f'Error uploading files:')             
                         #delete the file.
                         print(f"{datetime.now()} Deleting {file_path}")
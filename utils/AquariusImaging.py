@@ -6,236 +6,1000 @@
 ########################################################################################################################
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.models import CaseInsensitiveDict
 import os
 import time
 from datetime import datetime
 from datetime import timedelta
+from datetime import timezone
 import json
+import io
+import copy
+import codecs
 import mimetypes
 import magic
+import threading
+import tempfile
+import uuid
+import weakref
+import random
+from email.utils import parsedate_to_datetime
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
+from utils.AquariusThrottle import get_server_throttle
+from utils.AquariusCache import get_shared_query_definition_cache
+
+MB = 1024 * 1024  # Bytes in a Megabyte
+MAX_UPLOAD_SIZE = 4 * MB  # Largest request body we build out of several pages
+DOWNLOAD_CHUNK_SIZE = 256 * 1024  # Bytes held in memory at a time when streaming a page to disk
+PAGE_SPILL_SIZE = 8 * MB  # Pages larger than this are moved from memory to a temporary file
+
+# the connection failed, before or partway through the body. worth sending the request again.
+TRANSPORT_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+class AquariusToken:
+    """
+    Holds the access token handed out by the /token endpoint.
+    Both AquariusWebAPIWrapper and AsyncAquariusWebAPIWrapper use it, so tokens are read and refreshed the same way
+    whatever transport sends the request.
+    """
+
+    # refresh this many seconds before the server expires the token
+    REFRESH_MARGIN = 120
+
+    def __init__(self):
+        self.expiresAt = None
+        self.refresh_token = None
+        self.headers = MappingProxyType({})
+        self.Authenticated = False
+        # goes up by one every time a new token is read, so callers can tell whether the token they used is stale.
+        self.generation = 0
+
+    @staticmethod
+    def password_form(username, password):
+        return {'username': username,'password': password, 'grant_type':'password'}
+
+    def refresh_form(self):
+        return {'refresh_token': self.refresh_token, 'grant_type':'refresh_token'}
+
+    def needs_refresh(self):
+        return self.expiresAt is not None and datetime.now() >= self.expiresAt
+
+    def read(self, status_code, payload, text):
+        """
+        Reads a /token response. payload is the parsed json body (only used when status_code is 200).
+        """
+        #if authentication was successful
+        if status_code==200:
+            #get the authentication token
+            token = payload['access_token']
+            self.expiresAt = datetime.now() + timedelta(seconds=payload['expires_in'] - self.REFRESH_MARGIN)
+            print(f'{datetime.now()} token expires at: {str(self.expiresAt)}')
+            self.refresh_token = payload['refresh_token']
+            # the headers are swapped in as a whole and can't be changed afterwards, so a request always sees
+            # a complete set of headers, even while another thread reads a new token.
+            self.headers = MappingProxyType({'Authorization': 'Bearer ' + token})
+            self.generation += 1
+
+            self.Authenticated = True
+            return True
+        else:
+            print(f'{datetime.now()} Error reading token: {str(status_code)} {text}')
+            return False
+
+    def read_response(self, response):
+        return self.read(response.status_code, response.json() if response.status_code==200 else None, response.text)
+
+    def renew(self, credentials):
+        """
+        The steps to replace the token: the refresh token first, then a password login with credentials (a
+        (username, password) tuple, or None) if the refresh token is missing or rejected.
+        This is a generator that yields each /token form to send and is sent the response, and returns True once a
+        new token has been read. The sync and async token managers both drive it, each over its own transport.
+        """
+        if self.refresh_token:
+            response = yield self.refresh_form()
+            if self.read_response(response):
+                return True
+        return (yield from self.login(credentials))
+
+    def login(self, credentials):
+        """
+        The step to log in with credentials, driven like renew.
+        """
+        if credentials is None:
+            return False
+        response = yield self.password_form(*credentials)
+        return self.read_response(response)
+
+
+def run_token_steps(steps, post_token):
+    """
+    Drives AquariusToken.renew or login, sending each form with post_token. Returns True if a token was read.
+    """
+    response = None
+    try:
+        while True:
+            response = post_token(steps.send(response))
+    except StopIteration as done:
+        return done.value
+
+
+class TokenManager:
+    """
+    Keeps the access token of an AquariusWebAPIWrapper current for every thread using the wrapper.
+    A background timer refreshes the token shortly before it expires, so requests normally never wait for /token.
+    Refreshes are single flight: however many threads find the token expired (or get a 401) at once, only one
+    /token request is made and the rest wait for its result.
+    """
+
+    # the background refresh runs this many seconds before the token is due for a refresh
+    BACKGROUND_REFRESH_LEAD = 30
+    # wait this long before trying again when a background refresh fails
+    BACKGROUND_RETRY_DELAY = 30
+
+    def __init__(self, post_token, background_refresh=True):
+        # post_token sends a /token form and returns the response
+        self._post_token = post_token
+        self._background_refresh = background_refresh
+        self.token = AquariusToken()
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._timer = None
+        self._stopped = False
+
+    def snapshot(self):
+        """
+        Returns the current token generation and its (read only) headers.
+        Pass the generation to reauthenticate if the server rejects the headers.
+        """
+        token = self.token
+        return token.generation, token.headers
+
+    def authenticate(self, username, password):
+        with self._lock:
+            # remembered so the manager can log in again if the refresh token is rejected
+            self._credentials = (username, password)
+            self.__login()
+
+    def ensure_fresh(self):
+        """
+        Refreshes the token if it is due, unless another thread is already doing it.
+        """
+        if self.token.needs_refresh():
+            self.__refresh(self.token.generation, 'refreshing access token')
+
+    def reauthenticate(self, generation):
+        """
+        Called when a request made with the given token generation got a 401. The first caller gets a new token,
+        callers that were rejected with the same (now replaced) token just use the new one.
+        """
+        self.__refresh(generation, 'access token rejected, re-authenticating')
+
+    def stop(self):
+        self._stopped = True
+        if self._timer is not None:
+            self._timer.cancel()
+
+    def __refresh(self, generation, reason):
+        with self._lock:
+            # someone else already replaced the token while we were waiting for the lock.
+            if self.token.generation != generation:
+                return
+
+            print(f'{datetime.now()} {reason}')
+            self.__run(self.token.renew(self._credentials))
+
+    def __login(self):
+        self.__run(self.token.login(self._credentials))
+
+    def __run(self, steps):
+        if run_token_steps(steps, self._post_token):
+            remaining = (self.token.expiresAt - datetime.now()).total_seconds()
+            # short lived tokens are refreshed half way through instead.
+            self.__schedule(remaining - self.BACKGROUND_REFRESH_LEAD if remaining > 2 * self.BACKGROUND_REFRESH_LEAD else remaining / 2)
+
+    def __schedule(self, delay):
+        if not self._background_refresh or self._stopped:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(max(delay, 1), self.__background)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def __background(self):
+        try:
+            self.__refresh(self.token.generation, 'refreshing access token in the background')
+        except Exception as ex:
+            print(f'{datetime.now()} Error refreshing access token: {str(ex)}')
+            self.__schedule(self.BACKGROUND_RETRY_DELAY)
+
+
+class AquariusResponse:
+    """
+    A fully read response with the parts of requests.Response the scripts use (status_code, headers, content,
+    text, reason and json()), for responses that don't come from requests.
+    """
+
+    def __init__(self, status_code, headers, content, reason='', encoding='utf-8'):
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+        self.reason = reason
+        self.encoding = encoding or 'utf-8'
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors='replace')
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def get_mime_type(filepath):
+    """
+    Returns the MIME type for the given filepath.
+    """
+    mime_type, _ = mimetypes.guess_type(filepath)
+    if mime_type is None:
+        mime_type = 'application/octet-stream'  # Default MIME type if unknown
+    return mime_type
+
+
+def page_content_type(page_content, filename):
+    """
+    Infers the MIME type of a page held in memory and returns the filename (with a matching extension) and MIME type
+    to upload it with.
+    """
+    # Infer the MIME type from the content
+    mime = magic.Magic(mime=True)
+    mime_type = mime.from_buffer(page_content)
+    
+    # Map MIME type to file extension
+    extension = mimetypes.guess_extension(mime_type)
+    if extension == '.tiff':
+        extension = '.tif'
+        
+    return filename + extension, mime_type
+
+
+def save_response_to_file(response, filepath, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Streams the body of a response (requested with stream=True) to filepath, chunk_size bytes at a time, so memory
+    use doesn't depend on the size of the page. The body goes to a temporary file in the same folder, which is renamed
+    to filepath once it is complete, so a partly written page is never left behind under its final name.
+    """
+    directory = os.path.dirname(os.path.abspath(filepath))
+    temp_file = tempfile.NamedTemporaryFile(dir=directory, prefix=os.path.basename(filepath) + '.', suffix='.part', delete=False)
+    try:
+        with temp_file:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                temp_file.write(chunk)
+        os.replace(temp_file.name, filepath)
+    except BaseException:
+        os.remove(temp_file.name)
+        raise
+    finally:
+        response.close()
+    return filepath
+
+
+def iter_json_array(chunks):
+    """
+    Parses a json array of objects from an iterable of byte chunks and yields the objects one at a time, as soon as
+    each one has arrived, without ever holding the whole array in memory. Raises ValueError if the chunks end before
+    the array is closed, or if anything but whitespace follows it.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    buffer = ''
+    position = 0
+    started = False
+    closed = False
+
+    for chunk in chunks:
+        buffer = buffer[position:] + text_decoder.decode(chunk)
+        position = 0
+
+        while True:
+            # skip whitespace, and the commas between objects
+            while position < len(buffer) and (buffer[position] in ' \t\r\n' or (started and buffer[position] == ',')):
+                position += 1
+
+            if position >= len(buffer):
+                break
+            if closed:
+                raise ValueError(f'Unexpected data after the json array: {buffer[position:position + 100]}')
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError(f'Expected a json array, got: {buffer[position:position + 100]}')
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                closed = True
+                position += 1
+                continue
+
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # the object isn't complete yet, wait for the next chunk
+                break
+
+            position = end
+            yield item
+
+    remainder = (buffer[position:] + text_decoder.decode(b'', final=True)).strip()
+    if not closed:
+        raise ValueError(f'The json array ended before it was closed: {remainder[:100]}')
+    if remainder:
+        raise ValueError(f'Unexpected data after the json array: {remainder[:100]}')
+
+
+class PageBuffer:
+    """
+    A page held in memory on its way from a splitter or renderer to the upload, so it is never written to disk and
+    read back. Like tempfile.SpooledTemporaryFile, a page that grows past spill_size bytes is moved to a temporary
+    file (in spill_dir) as it is written, so one huge page can't use up the memory. A spill_size of None keeps every
+    page in memory. AddPageToDocument and AddPagesToDocument accept a PageBuffer wherever they accept a file path.
+    """
+
+    def __init__(self, name, mime_type=None, spill_size=PAGE_SPILL_SIZE, spill_dir=None):
+        self.name = name
+        self.mime_type = mime_type or get_mime_type(name)
+        self.spill_size = spill_size
+        self.spill_dir = spill_dir
+        self.path = None  # the temporary file, once the page has been moved to disk
+        self._file = io.BytesIO()
+
+    @property
+    def spilled(self):
+        return self.path is not None
+
+    def write(self, data):
+        if self.path is None and self.spill_size is not None and self._file.tell() + len(data) > self.spill_size:
+            self._spill()
+        return self._file.write(data)
+
+    def _spill(self):
+        spill_file = tempfile.NamedTemporaryFile(dir=self.spill_dir, suffix=os.path.splitext(self.name)[1], delete=False)
+        position = self._file.tell()
+        spill_file.write(self._file.getvalue())
+        spill_file.seek(position)
+        self._file = spill_file
+        self.path = spill_file.name
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def truncate(self, size=None):
+        return self._file.truncate(size)
+
+    def seekable(self):
+        return True
+
+    def flush(self):
+        self._file.flush()
+
+    def __len__(self):
+        if self.path is not None:
+            self._file.flush()
+            return os.path.getsize(self.path)
+        return self._file.getbuffer().nbytes
+
+    def getvalue(self):
+        """
+        Returns the whole page as bytes.
+        """
+        with self.open() as f:
+            return f.read()
+
+    def open(self):
+        """
+        Returns a new file object that reads the page from the start, without moving this buffer's position,
+        so an upload can be retried or sent again.
+        """
+        if self.path is not None:
+            self._file.flush()
+            return open(self.path, 'rb')
+        return io.BytesIO(self._file.getvalue())
+
+    def close(self):
+        self._file.close()
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+def page_part(page):
+    """
+    Returns the (filename, source, mime_type) multipart part for a page given as a file path or a PageBuffer.
+    """
+    if isinstance(page, PageBuffer):
+        return page.name, page, page.mime_type
+    return os.path.basename(page), page, get_mime_type(page)
+
+
+def page_size(page):
+    return len(page) if isinstance(page, PageBuffer) else os.path.getsize(page)
+
+
+def open_page(page):
+    """
+    Opens a page given as a file path or a PageBuffer for reading.
+    """
+    return page.open() if isinstance(page, PageBuffer) else open(page, 'rb')
+
+
+def batch_page_files(filepaths, max_size=MAX_UPLOAD_SIZE):
+    """
+    Groups pages (file paths or PageBuffers), in order, into batches of at most max_size bytes so several pages go up
+    in one request. A page that is larger than max_size on its own gets a batch to itself.
+    """
+    accumulated_size = 0
+    accumulated_files = []
+
+    for filepath in filepaths:
+        file_size = page_size(filepath)
+
+        # If the current file alone exceeds the limit, send it on its own after whatever we have so far.
+        if file_size > max_size:
+            if accumulated_files:
+                yield accumulated_files
+                accumulated_files = []
+                accumulated_size = 0
+            yield [filepath]
+            continue
+
+        # If adding the current file exceeds the limit
+        if accumulated_size + file_size > max_size:
+            yield accumulated_files
+            accumulated_files = []
+            accumulated_size = 0
+
+        # Add the current file to the accumulator
+        accumulated_files.append(filepath)
+        accumulated_size += file_size
+
+    # Send any remaining files
+    if accumulated_files:
+        yield accumulated_files
+
+
+class RetryPolicy:
+    """
+    Decides when and how long to wait before a failed request is sent again.
+    Waits grow exponentially from backoff_base up to backoff_max seconds, with full jitter so clients that failed
+    together don't retry together. A Retry-After header from the server takes precedence (capped at backoff_max).
+    Requests that aren't idempotent (POST) are only retried if retry_non_idempotent is set, since the server may
+    have acted on the first attempt.
+    """
+
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+    def __init__(self, max_attempts=8, backoff_base=1, backoff_max=60, jitter=True,
+                 retry_statuses=(429, 500, 502, 503, 504), retry_non_idempotent=False):
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.retry_statuses = retry_statuses
+        self.retry_non_idempotent = retry_non_idempotent
+
+    def can_retry(self, method, attempt, idempotent=None):
+        """
+        Returns True if a request that has been tried attempt times may be tried again.
+        """
+        if idempotent is None:
+            idempotent = method.upper() in self.IDEMPOTENT_METHODS
+        return attempt < self.max_attempts and (idempotent or self.retry_non_idempotent)
+
+    def should_retry_status(self, status_code):
+        return status_code in self.retry_statuses
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Returns the number of seconds to wait after the given (1 based) attempt failed.
+        retry_after is the value of the Retry-After header, if the server sent one.
+        """
+        server_delay = self.parse_retry_after(retry_after)
+        if server_delay is not None:
+            return min(server_delay, self.backoff_max)
+
+        backoff = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+        return random.uniform(0, backoff) if self.jitter else backoff
+
+    @staticmethod
+    def parse_retry_after(value):
+        # Retry-After is either a number of seconds or an HTTP date
+        if not value:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+        except (TypeError, ValueError):
+            return None
+
+
+class MultipartBody:
+    """
+    A multipart/form-data request body that is read from disk (or memory) while requests sends it, rather than
+    built in memory up front. parts is a list of (filename, source, mime_type) tuples, where source is a file path,
+    a PageBuffer or bytes. A file is only opened when the upload reaches it and is closed as soon as it has been sent (or when
+    close() is called), so an upload never holds more than one file handle.
+    """
+
+    def __init__(self, parts, field_name='file'):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + self.boundary
+
+        # the body is a list of segments, each either bytes, a file path or a PageBuffer.
+        self._segments = []
+        for filename, source, mime_type in parts:
+            filename = filename.replace('"', '%22')
+            self._segments.append(bytes(f'--{self.boundary}\r\nContent-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\nContent-Type: {mime_type}\r\n\r\n', 'UTF-8'))
+            self._segments.append(source)
+            self._segments.append(b'\r\n')
+        self._segments.append(bytes(f'--{self.boundary}--\r\n', 'UTF-8'))
+
+        self._length = sum(len(segment) if isinstance(segment, bytes) else page_size(segment) for segment in self._segments)
+        self._index = 0
+        self._current = None
+
+    def __len__(self):
+        # lets requests send a Content-Length header instead of a chunked body
+        return self._length
+
+    def read(self, size=-1):
+        data = bytearray()
+        while self._index < len(self._segments) and (size < 0 or len(data) < size):
+            if self._current is None:
+                segment = self._segments[self._index]
+                self._current = io.BytesIO(segment) if isinstance(segment, bytes) else open_page(segment)
+
+            chunk = self._current.read(-1 if size < 0 else size - len(data))
+            if chunk:
+                data += chunk
+            else:
+                # this segment is done, close it before moving on to the next one
+                self._current.close()
+                self._current = None
+                self._index += 1
+        return bytes(data)
+
+    def close(self):
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+        self._index = len(self._segments)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class PageBatchResult:
+    """
+    The outcome of sending one batch of pages: the pages in the batch and the response the server sent back.
+    """
+
+    def __init__(self, pages, response):
+        self.pages = pages
+        self.response = response
+
+    @property
+    def status_code(self):
+        return self.response.status_code
+
+
+class AddPagesResult:
+    """
+    Returned by AddPagesToDocument, with one PageBatchResult per request sent, in page order. Sending stops at the
+    first batch that fails, so pages never end up out of order; pages_not_sent lists the pages that were held back.
+    status_code is the status of the failed batch, or of the last one if they all went through, so existing
+    `AddPagesToDocument(...).status_code != 200` checks keep working.
+    """
+
+    def __init__(self, docID):
+        self.docID = docID
+        self.batches = []
+        self.pages_not_sent = []
+
+    @property
+    def last_response(self):
+        return self.batches[-1].response if self.batches else None
+
+    @property
+    def status_code(self):
+        return self.last_response.status_code if self.batches else None
+
+    @property
+    def ok(self):
+        return all(batch.status_code == 200 for batch in self.batches) and not self.pages_not_sent
+
+
+def release_throttle_when_read(response, throttle, started):
+    """
+    Gives back the throttle slot of a streamed response once its body has been read to the end or the response is
+    closed, which is when urllib3 hands the connection back to the pool (or when the response is garbage collected).
+    """
+    release_conn = response.raw.release_conn
+    once = threading.Lock()
+    status_code = response.status_code
+
+    def release():
+        if once.acquire(blocking=False):
+            throttle.release(started, status_code)
+
+    def release_conn_and_slot():
+        release_conn()
+        release()
+
+    response.raw.release_conn = release_conn_and_slot
+    weakref.finalize(response, release)
+
 
 class AquariusWebAPIWrapper:
     
-    def __init__(self,server):
+    def __init__(self,server, pool_connections=4, pool_maxsize=16, pool_block=True, keep_alive=True, gzip=True, background_token_refresh=True, retry_policy=None,
+                 throttle=True, rate_limit=None, query_definition_cache=None):
         self.server=server
-        self.Authenticated =False
+        # query definitions rarely change, so they are cached (see GetQueryDefinition)
+        self.query_definition_cache = query_definition_cache or get_shared_query_definition_cache()
+        self.retry_policy = retry_policy or RetryPolicy()
+
+        # requests per second (rate_limit) and requests in flight are limited per server, across every wrapper in
+        # the process, see utils.AquariusThrottle.
+        self.throttle = get_server_throttle(server, rate=rate_limit) if throttle else None
+
+        # every call shares one session so connections (and their TLS handshakes) are reused.
+        # requests.Session is safe to share between threads as long as nothing mutates it after
+        # it is created, so per-call state such as the authorization header is passed on each request.
+        self.session = self._create_session(pool_connections, pool_maxsize, pool_block, keep_alive, gzip)
+
+        self.tokens = TokenManager(lambda form: self.session.post(self.server + '/token', form), background_token_refresh)
+
+    def _create_session(self, pool_connections, pool_maxsize, pool_block, keep_alive, gzip):
+        """
+        Creates the pooled HTTP session used by all the api calls.
+        pool_maxsize is the number of connections kept open per host, and should be at least the number of
+        threads that use this wrapper at once. With pool_block set, extra threads wait for a free connection
+        instead of opening (and throwing away) a new one.
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        # json responses compress well, page images generally don't (see GetPage).
+        session.headers['Accept-Encoding'] = 'gzip, deflate' if gzip else 'identity'
+        session.headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+        return session
+
+    @property
+    def token(self):
+        return self.tokens.token
+
+    @property
+    def Authenticated(self):
+        return self.token.Authenticated
+
+    @property
+    def headers(self):
+        return self.token.headers
+
+    def close(self):
+        """
+        Stops the background token refresh and closes the pooled connections.
+        """
+        self.tokens.stop()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def get_mime_type(self,filepath):
         """
         Returns the MIME type for the given filepath.
         """
-        mime_type, _ = mimetypes.guess_type(filepath)
-        if mime_type is None:
-            mime_type = 'application/octet-stream'  # Default MIME type if unknown
-        return mime_type
+        return get_mime_type(filepath)
     
     #Authenticate
     def authenticate(self,username,password):
         
-        creds = {'username': username,'password': password, 'grant_type':'password'}
-        response = requests.post(self.server + '/token',creds)
-        headers=""
+        self.tokens.authenticate(username,password)
 
-        self.__readToken(response)
-        
-    def __refreshToken(self):
-       
-        if (datetime.now() >= self.expiresAt):
-            #refresh the token
-            print(f'{datetime.now()} refreshing access token')
+    def _send(self, method, url, headers=None, multipart=None, idempotent=None, **kwargs):
+        """
+        Sends a request with the current access token. headers are added to the authorization header, and multipart
+        is a list of (filename, source, mime_type) parts to send as a streamed multipart body.
+        Connection errors and retryable status codes are retried as far as the wrapper's RetryPolicy allows. Pass
+        idempotent to override whether the policy treats the request as safe to send again.
+        """
+        attempt = 0
+        reauthenticated = False
 
-            creds = {'refresh_token': self.refresh_token, 'grant_type':'refresh_token'}
-            response = requests.post(self.server + '/token',creds)
-            
-            self.__readToken(response)
+        while True:
+            attempt += 1
+            self.tokens.ensure_fresh()
+            generation, token_headers = self.tokens.snapshot()
+            request_headers = CaseInsensitiveDict(token_headers)
+            request_headers.update(headers or {})
 
-    def __readToken(self,response):
-        #if authentication was successful
-        if response.status_code==200:
-            #get the authentication token
-            token = response.json()['access_token']
-            self.expiresAt = datetime.now() + timedelta(seconds=response.json()['expires_in'] - 120)
-            print(f'{datetime.now()} token expires at: {str(self.expiresAt)}')
-            self.refresh_token = response.json()['refresh_token']
-            self.headers =  CaseInsensitiveDict()
-            self.headers['Authorization'] = 'Bearer ' + token
+            try:
+                response = self.__request(method, url, request_headers, multipart, **kwargs)
+            except TRANSPORT_ERRORS as ex:
+                if not self.retry_policy.can_retry(method, attempt, idempotent):
+                    raise
+                self.__wait(attempt, None, method, url, str(ex))
+                continue
 
-            self.Authenticated = True
-        else:
-            print(f'{datetime.now()} Error reading token: {str(response.status_code)} {response.text}')
+            if response.status_code == 401 and not reauthenticated:
+                # the token was rejected. renew it (once for all the threads that hit the same 401) and send the
+                # request again straight away, without counting it as an attempt.
+                response.close()
+                reauthenticated = True
+                attempt -= 1
+                self.tokens.reauthenticate(generation)
+                continue
+
+            if self.retry_policy.should_retry_status(response.status_code) and self.retry_policy.can_retry(method, attempt, idempotent):
+                response.close()
+                self.__wait(attempt, response.headers.get('Retry-After'), method, url, str(response.status_code))
+                continue
+
+            return response
+
+    def __request(self, method, url, headers, multipart, **kwargs):
+        # sends one attempt of a request, within the limits of the server's throttle.
+        # for streamed responses the slot is held until the body has been read or the response is closed.
+        started = self.throttle.acquire() if self.throttle else None
+        status_code = None
+        timed_out = False
+        held = False
+        try:
+            if multipart is None:
+                response = self.session.request(method, url, headers=headers, **kwargs)
+            else:
+                # a body can only be read once, so every attempt gets a new one
+                with MultipartBody(multipart) as body:
+                    headers['Content-Type'] = body.content_type
+                    response = self.session.request(method, url, headers=headers, data=body, **kwargs)
+            status_code = response.status_code
+            if self.throttle and kwargs.get('stream'):
+                release_throttle_when_read(response, self.throttle, started)
+                held = True
+            return response
+        except requests.Timeout:
+            timed_out = True
+            raise
+        finally:
+            if self.throttle and not held:
+                self.throttle.release(started, status_code, timed_out)
+
+    def __wait(self, attempt, retry_after, method, url, reason):
+        delay = self.retry_policy.delay(attempt, retry_after)
+        print(f"{datetime.now()} retry {method} {url} in {delay:.1f}s ({reason})")
+        time.sleep(delay)
     
     #retrieve a page
-    def GetPage(self,docID,pageCounter,type):
+    def GetPage(self,docID,pageCounter,type,stream=False):
+        """
+        With stream set, only the headers are read here. Pass the response to save_response_to_file (or read it with
+        iter_content) to write the page to disk without holding it in memory.
+        """
+
+        # page images are already compressed, so don't make the server gzip them again.
+        page_headers = {'Accept-Encoding': 'identity'}
+
+        if (type=='image'):
+            response = self._send('GET', self.server + '/api/DocPages/' + docID + '/' + str(pageCounter),headers=page_headers,stream=stream)
         
+        else:
+            response = self._send('GET', self.server + '/api/DocPages/' + docID + '/' + str(pageCounter) + '/' + type,headers=page_headers,stream=stream)
+        
+        return response
+
+    #retrieve a page and stream it to disk
+    def SavePage(self, docID, pageCounter, type, filepath, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """
+        Streams a page to disk with save_response_to_file. If the connection fails partway through the body, the page
+        is requested again and the file written again from the start, as far as the wrapper's RetryPolicy allows.
+        filepath is the path to save to, or a function that returns it from the response.
+        Returns the response and the path the page was saved to, or None if the server didn't send the page.
+        """
+        attempt = 0
 
         while True:
-            self.__refreshToken()
+            attempt += 1
+            response = self.GetPage(docID, pageCounter, type, stream=True)
+            if response.status_code != 200:
+                # the body isn't read, so hand the connection back to the pool.
+                response.close()
+                return response, None
+
             try:
-                if (type=='image'):
-                    response = requests.get(self.server + '/api/DocPages/' + docID + '/' + str(pageCounter),headers=self.headers)
-                
-                else:
-                    response = requests.get(self.server + '/api/DocPages/' + docID + '/' + str(pageCounter) + '/' + type,headers=self.headers)
-                
-                break
-            except:
-                print(f"{datetime.now()} retry {docID} Page: { str(pageCounter)}" )
-                time.sleep(3)
-        
-        return response
+                return response, save_response_to_file(response, filepath(response) if callable(filepath) else filepath, chunk_size)
+            except TRANSPORT_ERRORS as ex:
+                if not self.retry_policy.can_retry('GET', attempt):
+                    raise
+                self.__wait(attempt, None, 'GET', response.url, str(ex))
 
 
     #retrieve a document
     def GetDocument(self,docID):
 
-        while True:
-            self.__refreshToken()
-
-            try:
-                response = requests.get(self.server + '/api/Documents/' + docID,headers=self.headers)
-                break
-            except: 
-                print(f"{datetime.now()} retry {docID}")
-                time.sleep(3)
+        response = self._send('GET', self.server + '/api/Documents/' + docID)
 
         return response
     
+    def _post_pages(self, docID, parts):
+        """
+        Posts pages to a document as one streamed multipart request. parts are (filename, source, mime_type) tuples.
+        """
+        return self._send("POST", self.server + '/api/DocPages/' + docID, multipart=parts)
+
     def AddPageToDocument(self,docID, filepath):
-        self.__refreshToken()
-        payload={}
-        
-        mime_type = self.get_mime_type(filepath)  # Dynamically get the MIME type
-    
-        files=[
-        ('file',(os.path.basename(filepath),open(filepath,'rb'),mime_type))
-        ]
-        response = requests.request("POST", self.server + '/api/DocPages/' + docID, headers=self.headers, data=payload, files=files)
         
-        #print(response.text) will always be 1 because it's one page at a time.
-
-        return response
+        #response.text will always be 1 because it's one page at a time.
+        return self._post_pages(docID, [page_part(filepath)])
 
     def AddPageContentToDocument(self, docID, page_content, filename):
-        self.__refreshToken()
-        payload = {}
-        
-        # Infer the MIME type from the content
-        mime = magic.Magic(mime=True)
-        mime_type = mime.from_buffer(page_content)
         
-        # Map MIME type to file extension
-        extension = mimetypes.guess_extension(mime_type)
-        if extension == '.tiff':
-            extension = '.tif'
-            
-        filename = filename + extension
+        filename, mime_type = page_content_type(page_content, filename)
 
-        files = [
-            ('file', (filename, page_content, mime_type))
-        ]
-        response = requests.request("POST", self.server + '/api/DocPages/' + docID, headers=self.headers, data=payload, files=files)
-        
-        return response
+        return self._post_pages(docID, [(filename, page_content, mime_type)])
 
     def AddPagesToDocument(self, docID, filepaths):
-        self.__refreshToken()
-
-        MB = 1024 * 1024  # Bytes in a Megabyte
-        MAX_SIZE = 4 * MB
-
-        def send_files(files_to_send):
-            """Helper function to send files."""
-            response = requests.request(
-                "POST", self.server + '/api/DocPages/' + docID, headers=self.headers, files=files_to_send
-            )
-            return response
-
-        accumulated_size = 0
-        accumulated_files = []
-        last_response = None  # This will hold the last response
+        """
+        Uploads pages (file paths or PageBuffers) to a document in order, several pages per request. Returns an
+        AddPagesResult with the response for every batch.
+        """
+        result = AddPagesResult(docID)
 
-        for filepath in filepaths:
-            file_size = os.path.getsize(filepath)
-            mime_type = self.get_mime_type(filepath)  # Dynamically get the MIME type
-    
-            # If the current file alone exceeds 4MB
-            if file_size > MAX_SIZE:
-                # Send accumulated files first (if any)
-                if accumulated_files:
-                    print(f"{datetime.now()} sending {len(accumulated_files)} files")
-                    last_response = send_files(accumulated_files)
-                    accumulated_files = []
-                    accumulated_size = 0
-              
-                # Send the large file
-                last_response = send_files([('file', (os.path.basename(filepath), open(filepath, 'rb'), mime_type))])
+        for batch in batch_page_files(filepaths):
+            # once a batch has failed, sending the rest would put the pages out of order.
+            if not result.ok:
+                result.pages_not_sent.extend(batch)
                 continue
 
-            # If adding the current file exceeds the 4MB limit
-            if accumulated_size + file_size > MAX_SIZE:
-                print(f"{datetime.now()} sending {len(accumulated_files)} files")
-                last_response = send_files(accumulated_files)
-                accumulated_files = []
-                accumulated_size = 0
-
-            # Add the current file to the accumulator
-            accumulated_files.append(('file', (os.path.basename(filepath), open(filepath, 'rb'), mime_type)))
-            accumulated_size += file_size
-
-        # Send any remaining files
-        if accumulated_files:
-            print(f"{datetime.now()} sending {len(accumulated_files)} files")
-            last_response = send_files(accumulated_files)
+            print(f"{datetime.now()} sending {len(batch)} files")
+            response = self._post_pages(docID, [page_part(filepath) for filepath in batch])
+            result.batches.append(PageBatchResult(batch, response))
 
-        return last_response
+        return result
 
+    def AddPagesToDocuments(self, uploads, max_workers=4):
+        """
+        Uploads pages to several documents at the same time. uploads maps each docID to its list of pages.
+        The pages of each document are still sent in order, one batch after another.
+        Returns a dictionary of docID to AddPagesResult.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='upload') as executor:
+            futures = {docID: executor.submit(self.AddPagesToDocument, docID, filepaths) for docID, filepaths in uploads.items()}
+            return {docID: future.result() for docID, future in futures.items()}
 
     
     def CreateDocument(self,newDocumentJson):
-        self.__refreshToken()
         
-        response = requests.post(self.server + '/api/Documents/', json=newDocumentJson, headers=self.headers)
+        response = self._send('POST', self.server + '/api/Documents/', json=newDocumentJson)
 
         return response
 
     def DeleteDocument(self,docID):
-        self.__refreshToken()
         try:
-            response = requests.delete(self.server + '/api/Documents/' + docID,headers=self.headers)
+            response = self._send('DELETE', self.server + '/api/Documents/' + docID)
             return response
-        except:
-            print(f"{datetime.now()} error deleting document: {response}" )
+        except requests.RequestException as ex:
+            print(f"{datetime.now()} error deleting document {docID}: {str(ex)}" )
         
-    def GetQueryDefinition(self,doctypeID):
+    def GetQueryDefinition(self,doctypeID,use_cache=True):
+        """
+        Returns the query definition for a doctype. Definitions are cached by server and doctype, so only the first
+        call (per process, or per cache lifetime when the cache is on disk) goes to the server. Every call to json()
+        on the response returns a new copy, so callers can change the definition freely.
+        """
+        if use_cache:
+            content = self.query_definition_cache.get(self.server, doctypeID)
+            if content is not None:
+                return AquariusResponse(200, {'Content-Type': 'application/json'}, content, 'OK')
 
-        self.__refreshToken()
+        response = self._send('GET', self.server + '/api/QueryDefs/' + doctypeID)
+
+        if response.status_code == 200:
+            self.query_definition_cache.set(self.server, doctypeID, response.content)
 
-        try:
-            response = requests.get(self.server + '/api/QueryDefs/' + doctypeID,headers=self.headers)
-            
-        except: 
-            print(f"{datetime.now()} retry {doctypeID}" )
-            time.sleep(3)
-        #check for good response.
-        # 
         return response
      
 
     def RunQuery(self,query):
         
+        response = self._send('GET', self._query_url(), params=self._query_params(query))
+
+        return response 
+
+    def IterQuery(self, query, chunk_size=64 * 1024, page_size=None, page_params=('pageNumber', 'pageSize')):
+        """
+        Runs a query and yields the matching documents one at a time while the results are still downloading,
+        so work can start on the first hit and memory doesn't grow with the size of the result set.
+
+        If the server supports paging, set page_size to fetch the results page_size documents per request; page_params
+        are the names of the page number and page size query string parameters. Don't page through a query whose
+        results you are deleting, as the pages shift underneath you.
+        """
+        if page_size is None:
+            yield from self.__iter_results(self._query_params(query), chunk_size)
+            return
+
+        page_number = 1
+        first_docID = None
         while True:
+            count = 0
+            for document in self.__iter_results(self._query_params(query, {page_params[0]: page_number, page_params[1]: page_size}), chunk_size):
+                # a server that ignores the paging parameters returns the first page every time.
+                if count == 0 and page_number > 1 and document.get('docID') == first_docID:
+                    return
+                if count == 0 and page_number == 1:
+                    first_docID = document.get('docID')
+                count += 1
+                yield document
 
-            self.__refreshToken()
+            if count < page_size:
+                return
+            page_number += 1
 
-            try:
-                response = requests.get(self.server + '/api/Documentss?json=' + query,headers=self.headers)
-                break
-            except: 
-                print(f"{datetime.now()} retry query")
-                time.sleep(3)
+    def __iter_results(self, params, chunk_size):
+        response = self._send('GET', self._query_url(), params=params, stream=True)
+        try:
+            if response.status_code != 200:
+                raise Exception(f'Error running query: {response.status_code} {response.text}')
+            yield from iter_json_array(response.iter_content(chunk_size=chunk_size))
+        finally:
+            response.close()
 
-        return response 
+    def _query_url(self):
+        return self.server + '/api/Documentss'
+
+    @staticmethod
+    def _query_params(query, extra=None):
+        # sent as query string parameters, so the json is percent-encoded (search values can contain & # +)
+        params = {'json': query}
+        params.update(extra or {})
+        return params
     
 class AQJsonHelper:
  
@@ -273,7 +1037,8 @@ class AQJsonHelper:
             if (field != ""):
                 queryFields.append({'searchValue': indexValues[value['index']], 'operatorString': 'eq', 'fieldName': fieldName, 'description': field, 'maxLength': 0, 'listValues': []})
 
-        thisQuery = self.queryDef
+        # work on a copy, so the query definition itself keeps its fields for the next query.
+        thisQuery = copy.deepcopy(self.queryDef)
         thisQuery["queryFields"] = queryFields
         return json.dumps(thisQuery)
   
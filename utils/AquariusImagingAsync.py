@@ -0,0 +1,286 @@
+########################################################################################################################
+#
+# Purpose: This script contains an asyncio version of AquariusWebAPIWrapper, for keeping many transfers in flight
+# from one thread. Methods return AquariusResponse objects, which have the same shape as the requests responses the
+# sync wrapper returns, so code written against one can be ported to the other.
+#
+# Example:
+#
+#   async with AsyncAquariusWebAPIWrapper(server, max_concurrency=200) as aqApi:
+#       await aqApi.authenticate(username, password)
+#       response = await aqApi.GetPage(docID, 1, 'image')
+#
+########################################################################################################################
+
+import asyncio
+import contextlib
+from datetime import datetime
+
+import aiohttp
+
+from utils.AquariusThrottle import get_server_throttle
+from utils.AquariusCache import get_shared_query_definition_cache
+from utils.AquariusImaging import AquariusToken, AquariusResponse, RetryPolicy, AddPagesResult, PageBatchResult, page_content_type, page_part, open_page, batch_page_files
+
+
+class AsyncTokenManager:
+    """
+    The asyncio counterpart of TokenManager: the same steps (AquariusToken.renew) and the same single flight
+    policy, with an asyncio lock, and no background refresh since there is no thread to run it on.
+    """
+
+    def __init__(self, post_token):
+        # post_token is a coroutine function that sends a /token form and returns the response
+        self._post_token = post_token
+        self.token = AquariusToken()
+        self._lock = None
+        self._credentials = None
+
+    def snapshot(self):
+        token = self.token
+        return token.generation, token.headers
+
+    async def authenticate(self, username, password):
+        async with self.__get_lock():
+            # remembered so the manager can log in again if the refresh token is rejected
+            self._credentials = (username, password)
+            await self.__run(self.token.login(self._credentials))
+
+    async def ensure_fresh(self):
+        if self.token.needs_refresh():
+            await self.__refresh(self.token.generation, 'refreshing access token')
+
+    async def reauthenticate(self, generation):
+        await self.__refresh(generation, 'access token rejected, re-authenticating')
+
+    def __get_lock(self):
+        # asyncio locks belong to the running event loop, so this is created on first use (like the session).
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def __refresh(self, generation, reason):
+        async with self.__get_lock():
+            # another task already replaced the token while we were waiting for the lock.
+            if self.token.generation != generation:
+                return
+
+            print(f'{datetime.now()} {reason}')
+            await self.__run(self.token.renew(self._credentials))
+
+    async def __run(self, steps):
+        # the async version of run_token_steps
+        response = None
+        try:
+            while True:
+                response = await self._post_token(steps.send(response))
+        except StopIteration as done:
+            return done.value
+
+
+class AsyncAquariusWebAPIWrapper:
+
+    def __init__(self, server, max_concurrency=50, pool_size=100, keepalive_timeout=30, timeout=300, retry_policy=None,
+                 throttle=True, rate_limit=None, query_definition_cache=None):
+        self.server = server
+        self.query_definition_cache = query_definition_cache or get_shared_query_definition_cache()
+        self.retry_policy = retry_policy or RetryPolicy()
+
+        # shared with the sync wrappers talking to the same server, see utils.AquariusThrottle.
+        self.throttle = get_server_throttle(server, rate=rate_limit) if throttle else None
+        self.tokens = AsyncTokenManager(lambda form: self._request('POST', self.server + '/token', data=form))
+
+        # caps the number of requests in flight, however many tasks call into the wrapper.
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+        self._pool_size = pool_size
+        self._keepalive_timeout = keepalive_timeout
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session = None
+
+    @property
+    def token(self):
+        return self.tokens.token
+
+    @property
+    def Authenticated(self):
+        return self.token.Authenticated
+
+    @property
+    def headers(self):
+        return self.token.headers
+
+    def _get_session(self):
+        # aiohttp sessions have to be created inside the running event loop, so this is done on first use.
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._pool_size, keepalive_timeout=self._keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self._timeout)
+        return self._session
+
+    async def close(self):
+        """
+        Closes the pooled connections.
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _request(self, method, url, headers=None, **kwargs):
+        """
+        Sends one request and reads the whole body, holding a concurrency slot (and a server throttle slot)
+        for the duration.
+        """
+        async with self._semaphore:
+            started = await self.throttle.acquire_async() if self.throttle else None
+            status_code = None
+            timed_out = False
+            try:
+                async with self._get_session().request(method, url, headers=headers, **kwargs) as response:
+                    content = await response.read()
+                    status_code = response.status
+                    return AquariusResponse(response.status, response.headers, content, response.reason, response.charset)
+            except asyncio.TimeoutError:
+                timed_out = True
+                raise
+            finally:
+                if self.throttle:
+                    self.throttle.release(started, status_code, timed_out)
+
+    async def _send(self, method, url, headers=None, form=None, idempotent=None, **kwargs):
+        """
+        Sends a request with the current access token, retrying connection errors and retryable status codes as far
+        as the wrapper's RetryPolicy allows. form is a function that builds the aiohttp.FormData to send; it is called
+        for every attempt with a contextlib.ExitStack that closes any files it opens once the attempt is over.
+        """
+        attempt = 0
+        reauthenticated = False
+
+        while True:
+            attempt += 1
+            await self.tokens.ensure_fresh()
+            generation, token_headers = self.tokens.snapshot()
+            request_headers = dict(token_headers)
+            request_headers.update(headers or {})
+
+            try:
+                with contextlib.ExitStack() as stack:
+                    if form is not None:
+                        kwargs['data'] = form(stack)
+                    response = await self._request(method, url, headers=request_headers, **kwargs)
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                if not self.retry_policy.can_retry(method, attempt, idempotent):
+                    raise
+                await self.__wait(attempt, None, method, url, str(ex))
+                continue
+
+            if response.status_code == 401 and not reauthenticated:
+                # the token was rejected. renew it (once for all the tasks that hit the same 401) and send the
+                # request again straight away, without counting it as an attempt.
+                reauthenticated = True
+                attempt -= 1
+                await self.tokens.reauthenticate(generation)
+                continue
+
+            if self.retry_policy.should_retry_status(response.status_code) and self.retry_policy.can_retry(method, attempt, idempotent):
+                await self.__wait(attempt, response.headers.get('Retry-After'), method, url, str(response.status_code))
+                continue
+
+            return response
+
+    async def __wait(self, attempt, retry_after, method, url, reason):
+        delay = self.retry_policy.delay(attempt, retry_after)
+        print(f"{datetime.now()} retry {method} {url} in {delay:.1f}s ({reason})")
+        await asyncio.sleep(delay)
+
+    #Authenticate
+    async def authenticate(self, username, password):
+
+        await self.tokens.authenticate(username, password)
+
+    #retrieve a page
+    async def GetPage(self, docID, pageCounter, type):
+
+        url = self.server + '/api/DocPages/' + docID + '/' + str(pageCounter)
+        if (type != 'image'):
+            url += '/' + type
+
+        # page images are already compressed, so don't make the server gzip them again.
+        return await self._send('GET', url, headers={'Accept-Encoding': 'identity'})
+
+    #retrieve a document
+    async def GetDocument(self, docID):
+
+        return await self._send('GET', self.server + '/api/Documents/' + docID)
+
+    async def AddPageContentToDocument(self, docID, page_content, filename):
+
+        filename, mime_type = page_content_type(page_content, filename)
+
+        def form(stack):
+            form = aiohttp.FormData()
+            form.add_field('file', page_content, filename=filename, content_type=mime_type)
+            return form
+
+        return await self._send('POST', self.server + '/api/DocPages/' + docID, form=form)
+
+    async def AddPagesToDocument(self, docID, filepaths):
+
+        result = AddPagesResult(docID)
+
+        for batch in batch_page_files(filepaths):
+            # once a batch has failed, sending the rest would put the pages out of order.
+            if not result.ok:
+                result.pages_not_sent.extend(batch)
+                continue
+
+            print(f"{datetime.now()} sending {len(batch)} files")
+
+            # aiohttp streams the file objects, and the handles are closed as soon as the batch is sent.
+            def form(stack, batch=batch):
+                form = aiohttp.FormData()
+                for filepath in batch:
+                    filename, source, mime_type = page_part(filepath)
+                    form.add_field('file', stack.enter_context(open_page(source)), filename=filename, content_type=mime_type)
+                return form
+
+            response = await self._send('POST', self.server + '/api/DocPages/' + docID, form=form)
+            result.batches.append(PageBatchResult(batch, response))
+
+        return result
+
+    async def CreateDocument(self, newDocumentJson):
+
+        return await self._send('POST', self.server + '/api/Documents/', json=newDocumentJson)
+
+    async def DeleteDocument(self, docID):
+        try:
+            return await self._send('DELETE', self.server + '/api/Documents/' + docID)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            print(f"{datetime.now()} error deleting document {docID}: {str(ex)}" )
+
+    async def GetQueryDefinition(self, doctypeID, use_cache=True):
+
+        # shares the sync wrapper's cache, see AquariusWebAPIWrapper.GetQueryDefinition
+        if use_cache:
+            content = self.query_definition_cache.get(self.server, doctypeID)
+            if content is not None:
+                return AquariusResponse(200, {'Content-Type': 'application/json'}, content, 'OK')
+
+        response = await self._send('GET', self.server + '/api/QueryDefs/' + doctypeID)
+
+        if response.status_code == 200:
+            self.query_definition_cache.set(self.server, doctypeID, response.content)
+
+        return response
+
+    async def RunQuery(self, query):
+
+        # sent as a query string parameter, so the json is percent-encoded
+        return await self._send('GET', self.server + '/api/Documentss', params={'json': query})
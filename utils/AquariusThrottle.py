@@ -0,0 +1,238 @@
+########################################################################################################################
+#
+# Purpose: This script contains client side flow control for the Aquarius Web API: a token bucket that caps the
+# request rate, and an adaptive (AIMD) limit on the number of requests in flight. One ServerThrottle is shared by
+# every wrapper that talks to the same server URL, so the downloader, the copier and the import services all back
+# off together when the server struggles.
+#
+########################################################################################################################
+
+import asyncio
+import collections
+import threading
+import time
+from datetime import datetime
+
+
+class TokenBucket:
+    """
+    Allows rate requests per second on average, with bursts of up to burst requests.
+    A rate of None means no limit.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self._lock = threading.Lock()
+        self.configure(rate, burst)
+
+    def configure(self, rate=None, burst=None):
+        with self._lock:
+            self.rate = rate
+            self.burst = burst or max(rate or 1, 1)
+            self._tokens = self.burst
+            self._updated = time.monotonic()
+
+    def try_acquire(self):
+        """
+        Takes a token if one is available and returns 0, otherwise returns the number of seconds until one will be.
+        """
+        if self.rate is None:
+            return 0
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limits the number of requests in flight, and adjusts the limit with AIMD (additive increase, multiplicative
+    decrease). Every time a full limit's worth of requests has completed, the limit goes up by one if their p95
+    latency stayed close to the best p95 seen so far. The limit is cut by decrease_factor when the p95 latency
+    rises past latency_tolerance times that baseline, or straight away when the server answers 429/503 or a request
+    times out (at most once per cooldown seconds, so one burst of errors doesn't collapse the limit).
+    Callers waiting for a slot get one in the order they asked, whether they block (acquire) or await
+    (acquire_async).
+    """
+
+    def __init__(self, initial_limit=16, min_limit=1, max_limit=256, decrease_factor=0.7, latency_tolerance=1.5, cooldown=1.0):
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        # the callers waiting for a slot, first come first served, as (waiter, wake) pairs
+        self._waiters = collections.deque()
+        self._latencies = []
+        self._baseline = None
+        self._last_decrease = 0
+
+    def _take_slot(self):
+        # called with the lock held. a free slot goes to whoever has been waiting longest.
+        if not self._waiters and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return True
+        return False
+
+    def _hand_over_slots(self):
+        # called with the lock held, after a slot was freed or the limit went up.
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter, wake = self._waiters.popleft()
+            self.in_flight += 1
+            wake()
+
+    def try_acquire(self):
+        with self._lock:
+            return self._take_slot()
+
+    def acquire(self):
+        with self._lock:
+            if self._take_slot():
+                return
+            waiter = threading.Event()
+            self._waiters.append((waiter, waiter.set))
+        waiter.wait()
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._take_slot():
+                return
+            waiter = loop.create_future()
+            # release() can run on any thread, the future is completed on its own loop
+            entry = (waiter, lambda: loop.call_soon_threadsafe(self._wake, waiter))
+            self._waiters.append(entry)
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            with self._lock:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                    raise
+            # the slot was handed over before the task was cancelled. if the future was cancelled first, _wake
+            # gives the slot back instead
+            if not waiter.cancelled():
+                self.release()
+            raise
+
+    def _wake(self, waiter):
+        if waiter.cancelled():
+            self.release()
+        else:
+            waiter.set_result(None)
+
+    def release(self, latency=None, overloaded=False):
+        """
+        Gives back a slot. latency is the response time of a request that completed normally; overloaded is set
+        when the server pushed back (429, 503 or a timeout). Pass neither for requests that failed for other reasons.
+        """
+        with self._lock:
+            self.in_flight -= 1
+
+            if overloaded:
+                self._decrease('server overloaded')
+            elif latency is not None:
+                self._latencies.append(latency)
+                if len(self._latencies) >= max(int(self.limit), 10):
+                    self._adjust()
+
+            self._hand_over_slots()
+
+    def _adjust(self):
+        latencies = sorted(self._latencies)
+        self._latencies = []
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+
+        if self._baseline is None or p95 < self._baseline:
+            self._baseline = p95
+        else:
+            # let the baseline drift up slowly, so a server that got slower for good doesn't pin the limit down.
+            self._baseline = self._baseline * 0.95 + p95 * 0.05
+
+        if p95 > self._baseline * self.latency_tolerance:
+            self._decrease(f'p95 latency {p95:.2f}s')
+        elif self.limit < self.max_limit:
+            self.limit += 1
+
+    def _decrease(self, reason):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+        print(f'{datetime.now()} {reason}, concurrency limit lowered to {int(self.limit)}')
+
+
+class ServerThrottle:
+    """
+    The rate limiter and concurrency limiter for one server. Use acquire()/release() around every request, or
+    acquire_async() from asyncio code.
+    """
+
+    # responses that mean the server wants us to slow down
+    OVERLOAD_STATUSES = (429, 503)
+
+    def __init__(self, rate=None, burst=None, **limiter_settings):
+        self.bucket = TokenBucket(rate, burst)
+        self.limiter = AdaptiveConcurrencyLimiter(**limiter_settings)
+
+    def acquire(self):
+        self.bucket.acquire()
+        self.limiter.acquire()
+        return time.monotonic()
+
+    async def acquire_async(self):
+        while True:
+            wait = self.bucket.try_acquire()
+            if wait == 0:
+                break
+            await asyncio.sleep(wait)
+        await self.limiter.acquire_async()
+        return time.monotonic()
+
+    def release(self, started, status_code=None, timed_out=False):
+        """
+        started is the value acquire returned. Leave status_code out if the request failed without a response.
+        """
+        if timed_out or status_code in self.OVERLOAD_STATUSES:
+            self.limiter.release(overloaded=True)
+        elif status_code is not None and status_code < 500:
+            self.limiter.release(latency=time.monotonic() - started)
+        else:
+            self.limiter.release()
+
+
+_throttles = {}
+_throttles_lock = threading.Lock()
+
+
+def get_server_throttle(server, rate=None, burst=None, **limiter_settings):
+    """
+    Returns the ServerThrottle shared by everything in this process that talks to server.
+    The settings are used by whichever caller creates it first; a rate passed later replaces the current one.
+    """
+    key = server.rstrip('/').lower()
+    with _throttles_lock:
+        throttle = _throttles.get(key)
+        if throttle is None:
+            throttle = _throttles[key] = ServerThrottle(rate, burst, **limiter_settings)
+        elif rate is not None:
+            throttle.bucket.configure(rate, burst)
+        return throttle
@@ -0,0 +1,102 @@
+from collections import namedtuple
+from PIL import Image
+from pyzbar.pyzbar import decode
+
+# Search zones, as (left, top, right, bottom) fractions of the page
+WHOLE_PAGE = (0, 0, 1, 1)
+TOP_HALF = (0, 0, 1, 0.5)
+BOTTOM_HALF = (0, 0.5, 1, 1)
+TOP_LEFT = (0, 0, 0.5, 0.5)
+TOP_RIGHT = (0.5, 0, 1, 0.5)
+BOTTOM_LEFT = (0, 0.5, 0.5, 1)
+BOTTOM_RIGHT = (0.5, 0.5, 1, 1)
+
+Barcode = namedtuple('Barcode', ['data', 'type', 'zone', 'scale'])
+
+def is_docid(data):
+    # Aquarius docIDs are 8 characters long
+    return len(data) == 8
+
+class BarcodeScanner:
+    """
+    Reads barcodes from a page in several passes, cheapest first, and stops at the first pass that finds one:
+      1. each zone, scaled down by each factor in scales (for example 0.5 reads a 300 DPI page at 150 DPI),
+      2. each zone at full resolution,
+      3. the whole page at full resolution, if full_page_fallback is set and zones doesn't already cover it.
+    Only the zone being read is converted to grayscale. Color pages are scaled down before the conversion, but bitonal
+    pages have to be converted at full resolution (once per zone), so with the default zones (the whole page) the
+    first pass over a bitonal page expands all of it to 8 bits; give zones where the barcode is usually printed to
+    keep the first passes small.
+    With a validator, barcodes it rejects are ignored, and the scan stops at the first barcode it accepts
+    (or collects every accepted barcode in the pass, when stop_at_first is off).
+    symbols restricts the barcode types zbar looks for (for example [ZBarSymbol.QRCODE]), which also saves time.
+    """
+    def __init__(self, zones=None, scales=(0.5,), symbols=None, validator=None, stop_at_first=True, full_page_fallback=True):
+        self.zones = zones or [WHOLE_PAGE]
+        self.scales = [scale for scale in scales if scale < 1] + [1]
+        self.symbols = symbols
+        self.validator = validator
+        self.stop_at_first = stop_at_first
+        self.full_page_fallback = full_page_fallback and WHOLE_PAGE not in self.zones
+
+    def scan(self, image):
+        """
+        Returns the barcodes found on a PIL image, as Barcode tuples.
+        """
+        passes = [(zone, scale) for scale in self.scales for zone in self.zones]
+        if self.full_page_fallback:
+            passes.append((WHOLE_PAGE, 1))
+
+        # grayscale copies of the bitonal and palette zones, by zone
+        converted = {}
+        for zone, scale in passes:
+            found = []
+            for result in decode(self._prepare(image, zone, scale, converted), symbols=self.symbols):
+                data = result.data.decode('utf-8')
+                if self.validator is None or self.validator(data):
+                    found.append(Barcode(data, result.type, zone, scale))
+                    if self.stop_at_first:
+                        return found
+            if found:
+                return found
+
+        return []
+
+    def scan_file(self, file_path, page=0):
+        """
+        Returns the barcodes found on one page (0 based) of an image file.
+        """
+        with Image.open(file_path) as img:
+            img.seek(page)
+            return self.scan(img)
+
+    def first(self, image):
+        """
+        Returns the data of the first barcode found on a PIL image, or None.
+        """
+        barcodes = self.scan(image)
+        return barcodes[0].data if barcodes else None
+
+    def _prepare(self, image, zone, scale, converted):
+        left, top, right, bottom = zone
+        width, height = image.size
+
+        # crop first, so the conversion and scaling only touch the zone
+        if zone != WHOLE_PAGE:
+            image = image.crop((int(left * width), int(top * height), int(right * width), int(bottom * height)))
+
+        if image.mode in ('1', 'P'):
+            # PIL only scales these with nearest neighbour, which loses thin bars, so they are converted before
+            # scaling. The converted zone is kept for the other passes over it.
+            if zone not in converted:
+                converted[zone] = image.convert('L')
+            image = converted[zone]
+
+        if scale < 1:
+            image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.BOX)
+
+        # other modes are scaled first, so the conversion only touches the smaller image
+        if image.mode != 'L':
+            image = image.convert('L')
+
+        return image
@@ -0,0 +1,155 @@
+########################################################################################################################
+#
+# Purpose: This class decides when a file that has just appeared in a watched folder is completely written, without
+# blocking the thread that reports file system events. New files are recorded as pending and checked on a timer by one
+# background thread: a file is handed on once its size and modified time haven't changed for stable_time seconds
+# (and it can be opened for reading), or straight away when the platform reports that the writer closed it.
+# Modified events push the check back. Files are handed to the callback on a separate thread, so a slow processor
+# doesn't hold up the checks. Files still pending when the tracker stops are returned to the caller.
+#
+########################################################################################################################
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import heapq
+import os
+import threading
+import time
+
+
+class FileStabilityTracker:
+
+    def __init__(self, callback, stable_time=2, check_interval=0.5, workers=1):
+        """
+        callback is called with the path of each file once it is stable, on one of workers threads.
+        check_interval is how often a file that is stable but still locked is tried again.
+        """
+        self.callback = callback
+        self.stable_time = stable_time
+        self.check_interval = check_interval
+
+        # path -> (size, mtime_ns, time of the last change)
+        self._pending = {}
+        # (due time, path), earliest first
+        self._schedule = []
+        self._condition = threading.Condition()
+        self._running = True
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='process')
+        self._thread = threading.Thread(target=self._run, name='stability', daemon=True)
+        self._thread.start()
+
+    def track(self, file_path):
+        """
+        Starts watching a new file. Returns straight away.
+        """
+        with self._condition:
+            if file_path in self._pending:
+                return
+            self._pending[file_path] = (None, None, time.monotonic())
+            self._schedule_check(file_path, time.monotonic())
+
+    def modified(self, file_path):
+        """
+        The file is still being written, so it can't be stable for another stable_time seconds.
+        """
+        with self._condition:
+            if file_path in self._pending:
+                size, mtime_ns, _ = self._pending[file_path]
+                self._pending[file_path] = (size, mtime_ns, time.monotonic())
+
+    def closed(self, file_path):
+        """
+        The writer closed the file, so it can be handed on without waiting.
+        """
+        with self._condition:
+            if self._pending.pop(file_path, None) is None:
+                return
+        self._dispatch(file_path)
+
+    def _schedule_check(self, file_path, due):
+        heapq.heappush(self._schedule, (due, file_path))
+        self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and (not self._schedule or self._schedule[0][0] > time.monotonic()):
+                    self._condition.wait(self._schedule[0][0] - time.monotonic() if self._schedule else None)
+                if not self._running:
+                    return
+                _, file_path = heapq.heappop(self._schedule)
+                if file_path not in self._pending:
+                    # already handed on, after a close event
+                    continue
+
+            if self._check(file_path):
+                self._dispatch(file_path)
+
+    def _check(self, file_path):
+        # returns True if the file is stable, otherwise schedules the next check
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            with self._condition:
+                self._pending.pop(file_path, None)
+            return False
+
+        now = time.monotonic()
+        with self._condition:
+            if file_path not in self._pending:
+                return False
+
+            size, mtime_ns, last_change = self._pending[file_path]
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                last_change = now
+                self._pending[file_path] = (stat.st_size, stat.st_mtime_ns, last_change)
+
+            if now - last_change < self.stable_time:
+                self._schedule_check(file_path, last_change + self.stable_time)
+                return False
+
+        # some writers (scanners, copies on Windows) keep the file locked until they're done
+        try:
+            with open(file_path, 'rb'):
+                pass
+        except PermissionError:
+            with self._condition:
+                self._schedule_check(file_path, now + self.check_interval)
+            return False
+        except FileNotFoundError:
+            with self._condition:
+                self._pending.pop(file_path, None)
+            return False
+
+        with self._condition:
+            return self._pending.pop(file_path, None) is not None
+
+    def _dispatch(self, file_path):
+        self._executor.submit(self._call, file_path)
+
+    def _call(self, file_path):
+        try:
+            self.callback(file_path)
+        except Exception as ex:
+            print(f'{datetime.now()} Error: {str(ex)}')
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def stop(self, wait=True):
+        """
+        Stops checking, and returns the files that were still pending (they may not be complete, so they aren't
+        handed to the callback). With wait, the files already handed on are finished first.
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        self._thread.join()
+        self._executor.shutdown(wait=wait)
+
+        with self._condition:
+            pending = sorted(self._pending)
+            self._pending.clear()
+        return pending
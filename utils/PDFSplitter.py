@@ -1,14 +1,19 @@
 import fitz  # PyMuPDF
 from PIL import Image
 import os
-import tempfile
+from utils.AquariusImaging import PageBuffer, PAGE_SPILL_SIZE
 
 class PDFSplitter:
-    def __init__(self, pdf_path, dpi=300, threshold=128):
+    """
+    Renders each page of a PDF to a bitonal Group 4 TIFF. The pages are PageBuffers, kept in memory unless they are
+    larger than spill_size, and can be passed straight to AddPageToDocument or AddPagesToDocument.
+    """
+    def __init__(self, pdf_path, dpi=300, threshold=128, spill_size=PAGE_SPILL_SIZE):
         self.pdf_path = pdf_path
         self.dpi = dpi
         self.threshold = threshold
-        self.temp_files = []
+        self.spill_size = spill_size
+        self.pages = []
         self.split_pdf()
 
     def split_pdf(self):
@@ -36,29 +41,29 @@ class PDFSplitter:
             # Convert the grayscale image to bitonal (black and white) with adjusted threshold
             bitonal_img = img.point(lambda x: 0 if x < self.threshold else 255, '1')
             
-            # Define the temporary output path
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".tif")
-            temp_path = temp_file.name
-            temp_file.close()
-            
             # Save the image as TIFF with Group 4 compression
-            bitonal_img.save(temp_path, format="TIFF", compression="group4", dpi=(self.dpi, self.dpi))
+            page_buffer = PageBuffer(f"{base_name}_{page_number + 1}.tif", 'image/tiff', spill_size=self.spill_size)
+            bitonal_img.save(page_buffer, format="TIFF", compression="group4", dpi=(self.dpi, self.dpi))
             
-            # Keep track of the temporary file path
-            self.temp_files.append(temp_path)
+            # Keep track of the page
+            self.pages.append(page_buffer)
 
         print(f"PDF split into {len(pdf_document)} bitonal TIFF files with Group 4 compression")
+        pdf_document.close()
 
-    def get_temp_files(self):
-        return self.temp_files
+    def get_pages(self):
+        return self.pages
 
     def cleanup(self):
-        for temp_file in self.temp_files:
-            try:
-                os.remove(temp_file)
-            except OSError:
-                pass
-        self.temp_files = []
+        for page in self.pages:
+            page.close()
+        self.pages = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
 
     def __del__(self):
         self.cleanup()
@@ -67,5 +72,5 @@ class PDFSplitter:
 #pdf_paths = ["~/Downloads/document1.pdf", "~/Downloads/document2.pdf"]
 #for pdf_path in pdf_paths:
 #    pdf_splitter = PDFSplitter(pdf_path, dpi=300, threshold=150)
-#    print(pdf_splitter.get_temp_files())
+#    print([page.name for page in pdf_splitter.get_pages()])
 #    pdf_splitter = None  # This will trigger the destructor and cleanup
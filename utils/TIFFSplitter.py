@@ -0,0 +1,53 @@
+import tifftools
+import os
+from utils.AquariusImaging import PageBuffer, PAGE_SPILL_SIZE
+
+class TIFFSplitter:
+    """
+    Splits a multipage TIFF into single page TIFFs without decoding the images. Each page's IFD and its
+    compressed strips or tiles are copied as they are, so Group 4 compression, DPI and the other tags are kept and
+    the page data is byte for byte the same as in the original file.
+    Pages before first_page are skipped (for example a barcode cover sheet).
+    The pages are PageBuffers, kept in memory unless they are larger than spill_size, and can be passed straight
+    to AddPagesToDocument.
+    """
+    def __init__(self, tiff_path, first_page=0, spill_size=PAGE_SPILL_SIZE):
+        self.tiff_path = tiff_path
+        self.first_page = first_page
+        self.spill_size = spill_size
+        self.page_count = 0
+        self.pages = []
+        self.split_tiff()
+
+    def split_tiff(self):
+        # Extract the base name of the TIFF file without the extension
+        base_name = os.path.splitext(os.path.basename(self.tiff_path))[0]
+
+        info = tifftools.read_tiff(self.tiff_path)
+        self.page_count = len(info['ifds'])
+
+        for page_number in range(self.first_page, self.page_count):
+            page = PageBuffer(f"{base_name}_{page_number + 1}.tif", 'image/tiff', spill_size=self.spill_size)
+
+            # Write the page on its own, keeping the byte order and tiff flavour of the original
+            tifftools.write_tiff({'ifds': [info['ifds'][page_number]], 'bigEndian': info['bigEndian'], 'bigtiff': info['bigtiff']}, page)
+
+            # Keep track of the page
+            self.pages.append(page)
+
+    def get_pages(self):
+        return self.pages
+
+    def cleanup(self):
+        for page in self.pages:
+            page.close()
+        self.pages = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+
+    def __del__(self):
+        self.cleanup()